@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image
+from pymongo import MongoClient
+
+from find_site import FindSite
+from find_subpage import FindSubPage
+from find_pic_caption import FindPicCaption, to_records
+from check_duplicate import CheckDuplicate
+from store_in_mongo import StoreInMongo
+from blob_cache import BlobCache
+from caption_index import caption_fingerprint
+from run_journal import item_key
+
+# Offline benchmark of the pipeline stages. A local HTTP server serves a synthetic
+# front page, a subpage with N <article> blocks and the images, MongoDB is either a
+# local mongod or an in-memory stand-in (mongomock).
+
+WORDS = ("minister market storm election court league energy city police climate "
+         "talks budget vote report record school health border trade festival").split()
+
+
+def synthetic_caption(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize()
+
+
+def synthetic_image(index, size=(640, 360)):
+    # Random blocks give every image a different perceptual hash
+    rng = random.Random(index)
+    small = Image.new("L", (8, 8))
+    small.putdata([rng.randint(0, 255) for _ in range(64)])
+    img = small.resize(size).convert("RGB")
+    data = io.BytesIO()
+    img.save(data, format="JPEG", quality=85)
+    return data.getvalue()
+
+
+class SyntheticSite:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.base_url = None
+        self.images = {}
+        self.images_lock = threading.Lock()
+
+    def front_page(self):
+        links = "".join(f'<li><a href="/section/{i}">Section {i}</a></li>' for i in range(50))
+        return (f'<html><head><base href="{self.base_url}/"><title>News</title></head><body><ul>{links}'
+                f'<li><a href="/top">Top stories</a></li></ul></body></html>').encode()
+
+    def subpage(self, articles, seed):
+        rng = random.Random(seed)
+        blocks = []
+        for i in range(articles):
+            blocks.append(f'<article><figure><img src="/img/{seed}-{i}.jpg"></figure>'
+                          f'<a href="/story/{seed}-{i}">{synthetic_caption(rng)}</a></article>')
+        return f'<html><body>{"".join(blocks)}</body></html>'.encode()
+
+    def image(self, name):
+        with self.images_lock:
+            if name not in self.images:
+                self.images[name] = synthetic_image(name)
+            return self.images[name]
+
+    def handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if site.latency:
+                    time.sleep(site.latency)
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                if parsed.path == "/":
+                    body, content_type = site.front_page(), "text/html"
+                elif parsed.path == "/top":
+                    articles = int(query.get("n", ["10"])[0])
+                    seed = int(query.get("seed", ["0"])[0])
+                    body, content_type = site.subpage(articles, seed), "text/html"
+                elif parsed.path.startswith("/img/"):
+                    body, content_type = site.image(parsed.path[5:]), "image/jpeg"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def mongo_client(address):
+    if address != "memory":
+        return MongoClient(address)
+    try:
+        import mongomock
+        import mongomock.gridfs
+    except ImportError:
+        print("The in-memory database needs mongomock: pip install mongomock", file=sys.stderr)
+        sys.exit(1)
+    mongomock.gridfs.enable_gridfs_integration()
+    return mongomock.MongoClient()
+
+
+def seed_collection(db, count, rng):
+    # Stored documents the duplicate check has to compare against
+    docs = []
+    for i in range(count):
+        caption = synthetic_caption(rng)
+        # Every stored document has a unique item key. mongomock ignores the partial filter
+        # of the unique item_key index, so documents without one would collide.
+        urls = {"caption_url": f"https://stored.example/article/{i}",
+                "full_img_url": f"https://stored.example/image/{i}.jpg"}
+        docs.append({
+            "caption": caption,
+            "caption_url": urls["caption_url"],
+            "image_url": urls["full_img_url"],
+            "item_key": item_key(urls),
+            "image_hash": format(rng.getrandbits(64), "016x"),
+            "caption_lsh": caption_fingerprint(caption),
+            "scrape_time": datetime.now().isoformat(),
+            "created_at": datetime.now(),
+        })
+        if len(docs) >= 1000:
+            db["captions"].insert_many(docs)
+            docs = []
+    if docs:
+        db["captions"].insert_many(docs)
+
+
+def timed(results, stage, articles, stored, items, func):
+    start = time.perf_counter()
+    value = func()
+    seconds = time.perf_counter() - start
+    results.append({
+        "stage": stage,
+        "articles": articles,
+        "stored": stored,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds > 0 else None,
+    })
+    return value
+
+
+def run_scenario(base_url, client, db_name, articles, stored, seed):
+    results = []
+    client.drop_database(db_name)
+    db = client[db_name]
+    seed_collection(db, stored, random.Random(seed))
+
+    html = timed(results, "FindSite", articles, stored, 1, lambda: FindSite(base_url + "/").get_html())
+    subpage_url = timed(results, "FindSubPage", articles, stored, 1,
+                        lambda: FindSubPage("Top stories", html).get_url())
+    subpage_url = f"{subpage_url}?n={articles}&seed={seed}"
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        blob_cache = BlobCache(cache_dir)
+        pic_caption = FindPicCaption(subpage_url, "article", "figure", "a", "img", blob_cache=blob_cache)
+        scraped = timed(results, "FindPicCaption", articles, stored, articles,
+                        lambda: to_records(pic_caption.get_articles()))
+
+        duplicate_checker = CheckDuplicate(db_name, client=client)
+        # The hash index is persisted in production, so it is loaded before the timing starts
+        duplicate_checker.hash_index.sync(db["captions"])
+        unique = timed(results, "CheckDuplicate", articles, stored, len(scraped),
+                       lambda: duplicate_checker.remove_duplicates(scraped))
+        duplicate_checker.close_connection()
+
+        mongo_store = StoreInMongo(db_name, client=client, blob_cache=blob_cache)
+        timed(results, "StoreInMongo", articles, stored, len(unique),
+              lambda: mongo_store.insert_data(unique))
+        mongo_store.close_connection()
+    client.drop_database(db_name)
+    return results
+
+
+def summarize(runs):
+    # Median over the repetitions of every (stage, articles, stored) combination
+    groups = {}
+    for result in runs:
+        groups.setdefault((result["stage"], result["articles"], result["stored"]), []).append(result)
+    summary = []
+    for (stage, articles, stored), results in groups.items():
+        seconds = statistics.median(result["seconds"] for result in results)
+        rates = [result["items_per_second"] for result in results if result["items_per_second"]]
+        summary.append({
+            "stage": stage,
+            "articles": articles,
+            "stored": stored,
+            "seconds": seconds,
+            "items_per_second": statistics.median(rates) if rates else None,
+        })
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    # Returns the results that got slower than the baseline by more than tolerance
+    previous = {(r["stage"], r["articles"], r["stored"]): r for r in baseline["results"]}
+    regressions = []
+    for result in summary:
+        old = previous.get((result["stage"], result["articles"], result["stored"]))
+        if not old or not old["seconds"]:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        result["baseline_seconds"] = old["seconds"]
+        result["ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the scraper pipeline stages")
+    parser.add_argument("--mongo", default="memory", help="MongoDB address or 'memory' for mongomock")
+    parser.add_argument("--database", default="benchmark_db")
+    parser.add_argument("--articles", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--stored", type=int, nargs="+", default=[0, 1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency per HTTP request")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="-", help="File for the JSON results, '-' for stdout")
+    parser.add_argument("--baseline", help="Earlier results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    site = SyntheticSite(args.latency)
+    base_url = site.start()
+    client = mongo_client(args.mongo)
+    runs = []
+    try:
+        for articles in args.articles:
+            for stored in args.stored:
+                for repetition in range(args.repeat):
+                    runs.extend(run_scenario(base_url, client, args.database, articles, stored, repetition))
+    finally:
+        site.stop()
+        client.close()
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "mongo": "memory" if args.mongo == "memory" else "mongod",
+        "latency": args.latency,
+        "repeat": args.repeat,
+        "results": summarize(runs),
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(report["results"], json.load(f), args.tolerance)
+        report["regressions"] = regressions
+
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+    if regressions:
+        for result in regressions:
+            print(f"Regression in {result['stage']} (articles={result['articles']}, stored={result['stored']}): "
+                  f"{result['seconds']:.4f}s vs {result['baseline_seconds']:.4f}s", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
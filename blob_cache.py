@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import threading
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class BlobCache:
+    # Content addressed image cache on disk. Blobs are stored under their sha256
+    # digest, the file modification time is used as LRU order for the eviction.
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self.entries())
+
+    def path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def entries(self):
+        # Yields (path, size, last_used) for every blob in the cache
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def put(self, data):
+        digest = content_digest(data)
+        path = self.path(digest)
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path)
+                return digest
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see half written blobs
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.total_bytes += len(data)
+            self.evict()
+        return digest
+
+    def get(self, digest):
+        path = self.path(digest)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        # Only hand out the exact bytes we hashed during the extraction
+        if content_digest(data) != digest:
+            self.discard(digest)
+            return None
+        return data
+
+    def discard(self, digest):
+        path = self.path(digest)
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+    def evict(self):
+        # Drop the least recently used blobs until the cache fits into max_bytes again
+        if self.total_bytes <= self.max_bytes:
+            return
+        for path, size, _ in sorted(self.entries(), key=lambda entry: entry[2]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except OSError:
+                pass
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import hashlib
+
+# MinHash over character 3-grams, split into bands for locality sensitive hashing.
+# With 16 bands of 2 rows, captions with a 3-gram Jaccard similarity of 0.4 end up
+# in a common band with ~94% probability, which covers a Levenshtein ratio of 0.8.
+SHINGLE_SIZE = 3
+BANDS = 16
+ROWS = 2
+PRIME = (1 << 61) - 1
+PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % PRIME)
+    for i in range(BANDS * ROWS)
+]
+
+
+def normalize_caption(caption):
+    return " ".join(caption.lower().split())
+
+
+def shingles(text):
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def caption_fingerprint(caption):
+    # Returns the band keys of the caption, these are stored with every caption document
+    text = normalize_caption(caption)
+    values = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles(text)]
+    signature = [min((a * v + b) % PRIME for v in values) for a, b in PERMUTATIONS]
+    keys = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS:(band + 1) * ROWS]
+        digest = hashlib.blake2b(repr(rows).encode(), digest_size=6).hexdigest()
+        keys.append(f"{band}:{digest}")
+    return keys
+
+
+def length_compatible(length1, length2, threshold):
+    # Levenshtein.ratio is at most 2 * min / (len1 + len2), so captions with very
+    # different lengths can never reach the threshold.
+    total = length1 + length2
+    return total == 0 or 2 * min(length1, length2) / total >= threshold
+
+
+class CaptionIndex:
+    # In memory LSH index, used for the captions within one batch
+    def __init__(self):
+        self.buckets = {}
+        self.captions = []
+
+    def add(self, caption, keys=None):
+        position = len(self.captions)
+        self.captions.append(caption)
+        for key in keys or caption_fingerprint(caption):
+            self.buckets.setdefault(key, []).append(position)
+
+    def candidates(self, keys):
+        positions = set()
+        for key in keys:
+            positions.update(self.buckets.get(key, ()))
+        return [self.captions[position] for position in sorted(positions)]
@@ -8,30 +8,94 @@ from PIL import Image
 import io
 import Levenshtein
 import base64
+from datetime import datetime, timedelta
+from hash_index import HashIndex, chunk_keys
+import metrics
+from record_stream import read_records, write_records
+from caption_index import CaptionIndex, caption_fingerprint, length_compatible
 
 class CheckDuplicate:
-    def __init__(self, db_name, client_address):
-        self.client = MongoClient(client_address)
+    def __init__(self, db_name, client_address=None, client=None, hash_index=None,
+                 horizon_days=None, horizon_docs=None):
+        # Reuse a shared client if one is handed in, otherwise open our own.
+        self.owns_client = client is None
+        self.client = client if client is not None else MongoClient(client_address)
         self.db = self.client[db_name]
         # Only look at the captions.
         self.captions_collection = self.db["captions"]
+        # Index of all stored image hashes, kept up to date incrementally
+        self.hash_index = hash_index if hash_index is not None else HashIndex()
+        # Only documents scraped within the horizon are compared. Without one the
+        # whole history is compared, the full sweep below does that offline.
+        self.horizon_days = horizon_days
+        self.horizon_docs = horizon_docs
+        self.window_start = None
 
-    def remove_duplicates(self, scraped_data):
-        filtered_data = []
-        seen_items= set()
+    def update_window(self):
+        # Start of the dedup window in the ISO format of scrape_time, None without horizon.
+        # Both horizons can be set, the shorter one wins.
+        starts = []
+        if self.horizon_days:
+            starts.append((datetime.now() - timedelta(days=self.horizon_days)).isoformat())
+        if self.horizon_docs:
+            # The scrape time of the horizon_docs-th newest document, read from the scrape_time index
+            nth_newest = list(self.captions_collection.find({"scrape_time": {"$type": "string"}}, {"scrape_time": 1})
+                              .sort("scrape_time", -1).skip(self.horizon_docs - 1).limit(1))
+            if nth_newest:
+                starts.append(nth_newest[0]["scrape_time"])
+        self.window_start = max(starts) if starts else None
+        if self.window_start is not None:
+            self.hash_index.prune(int(datetime.fromisoformat(self.window_start).timestamp()))
+        return self.window_start
+
+    def remove_duplicates(self, scraped_data, hash_threshold=5, caption_threshold=0.8):
+        return list(self.iter_unique(scraped_data, hash_threshold, caption_threshold))
+
+    def iter_unique(self, scraped_data, hash_threshold=5, caption_threshold=0.8, checked=()):
+        # Yields the items that are neither duplicates within the batch nor of the stored data
+        # Indexes of the items seen in this batch, so we only compare against likely candidates
+        seen_hashes = HashIndex(max_distance=hash_threshold)
+        seen_captions = CaptionIndex()
+        self.update_window()
+
+        # Items that passed the check before (in an interrupted run) are passed through,
+        # they only take part in the comparisons within the batch
+        for item in checked:
+            caption = item["caption"].lower()
+            seen_hashes.add(item["image_hash"])
+            seen_captions.add(caption, item.get("caption_lsh") or caption_fingerprint(caption))
+            yield item
 
         for item in scraped_data:
             current_hash = item["image_hash"]
-            current_caption = item["caption"]
-            # Skip if a similar hash has already been seen
-            if any(self.are_similar(current_hash, current_caption, seen_hash, seen_caption) for seen_hash, seen_caption in seen_items):
+            current_caption = item["caption"].lower()
+            caption_keys = caption_fingerprint(current_caption)
+            item["caption_lsh"] = caption_keys
+            # Skip if a similar hash or caption has already been seen
+            if seen_hashes.find_within(current_hash, hash_threshold) is not None:
+                metrics.inc("duplicates_total", reason="batch_hash")
+                continue
+            if self.similar_caption(current_caption, seen_captions.candidates(caption_keys), caption_threshold):
+                metrics.inc("duplicates_total", reason="batch_caption")
                 continue
-            seen_items.add((current_hash,current_caption))
+            seen_hashes.add(current_hash)
+            seen_captions.add(current_caption, caption_keys)
             # Check if the image is a duplicate to the db articles
-            if not self.is_duplicate(item["image_hash"], item["caption"]):
-                filtered_data.append(item)
+            with metrics.timer("stage_seconds", stage="CheckDuplicate"):
+                duplicate = self.is_duplicate(item["image_hash"], item["caption"], hash_threshold, caption_threshold, caption_keys)
+            if not duplicate:
+                yield item
 
-        return filtered_data
+    def similar_caption(self, caption, candidates, caption_threshold=0.8):
+        # Exact Levenshtein ratio, only run on the lowercased candidates of the LSH index
+        for candidate in candidates:
+            if not length_compatible(len(caption), len(candidate), caption_threshold):
+                continue
+            metrics.inc("caption_comparisons_total")
+            similarity = Levenshtein.ratio(caption, candidate)
+            if similarity >= caption_threshold:
+                return similarity
+        return None
     
     def are_similar(self, hash1, caption1, hash2, caption2, hash_threshold=5, caption_threshold=0.8):
         # Check image similarity
@@ -48,69 +112,178 @@ class CheckDuplicate:
         return False
 
 
-    def is_duplicate(self, image_hash, caption, hash_threshold=5, caption_threshold=0.8):
+    def is_duplicate(self, image_hash, caption, hash_threshold=5, caption_threshold=0.8, caption_keys=None):
         # Check against similarities to stored images (here we compare against stored image hashes in the captions_collection)
         if image_hash is None:
             return False
-        test_hash_obj = imagehash.hex_to_hash(image_hash)
-        for existing in self.captions_collection.find({}, {"image_hash": 1}):
-            existing_hash = existing.get("image_hash")
-            if existing_hash:
-                # Convert the stored hash string back to an imagehash object.
-                existing_hash_obj = imagehash.hex_to_hash(existing_hash)
-                distance = test_hash_obj - existing_hash_obj
-                if distance <= hash_threshold:
-                    print(f"Duplicate found based on image hash. Distance: {distance}")
-                    return True
-        # Check against similarities to stored captions
+        # Only fetches the documents stored since the last call
+        self.hash_index.sync(self.captions_collection, since=self.window_start)
+        match = self.hash_index.find_within(image_hash, hash_threshold)
+        if match is not None:
+            print(f"Duplicate found based on image hash. Distance: {match[1]}", file=sys.stderr)
+            metrics.inc("duplicates_total", reason="hash")
+            return True
+        # Check against similarities to stored captions that share an LSH band
         if caption:
-            for existing in self.captions_collection.find({}, {"caption": 1}):
-                if existing.get("caption"):
-                    similarity = Levenshtein.ratio(caption.lower(), existing["caption"].lower())
-                    if similarity >= caption_threshold:
-                        print(f"Duplicate found based on caption similarity. Similarity: {similarity}")
-                        return True
+            if caption_keys is None:
+                caption_keys = caption_fingerprint(caption)
+            query = {"caption_lsh": {"$in": caption_keys}}
+            if self.window_start is not None:
+                query["scrape_time"] = {"$gte": self.window_start}
+            candidates = [
+                existing["caption"].lower()
+                for existing in self.captions_collection.find(query, {"caption": 1})
+                if existing.get("caption")
+            ]
+            similarity = self.similar_caption(caption.lower(), candidates, caption_threshold)
+            if similarity is not None:
+                print(f"Duplicate found based on caption similarity. Similarity: {similarity}", file=sys.stderr)
+                metrics.inc("duplicates_total", reason="caption")
+                return True
         return False
 
+    def find_concurrent_duplicates(self, doc_id, image_hash, caption, caption_keys=None,
+                                   hash_threshold=5, caption_threshold=0.8):
+        # Check of a document that is already stored, used by the queue workers. Returns the
+        # _ids of all other stored near duplicates, whatever their _id. Of every pair the
+        # document with the larger _id has to go; this does not rely on the _ids being in
+        # insert order, so both workers agree on the survivor whichever insert they see first.
+        conditions = []
+        if image_hash:
+            conditions.append({"hash_chunks": {"$in": chunk_keys(image_hash)}})
+        if caption:
+            conditions.append({"caption_lsh": {"$in": caption_keys or caption_fingerprint(caption)}})
+        if not conditions:
+            return []
+        query = {"_id": {"$ne": doc_id}, "$or": conditions}
+        if self.window_start is not None:
+            query["scrape_time"] = {"$gte": self.window_start}
+        value = HashIndex.to_int(image_hash) if image_hash else None
+        caption = (caption or "").lower()
+        duplicates = []
+        for existing in self.captions_collection.find(query, {"image_hash": 1, "caption": 1}):
+            try:
+                if value is not None and existing.get("image_hash") and \
+                        bin(value ^ HashIndex.to_int(existing["image_hash"])).count("1") <= hash_threshold:
+                    metrics.inc("duplicates_total", reason="concurrent_hash")
+                    duplicates.append(existing["_id"])
+                    continue
+            except ValueError:
+                pass
+            if caption and existing.get("caption") and \
+                    self.similar_caption(caption, [existing["caption"].lower()], caption_threshold) is not None:
+                metrics.inc("duplicates_total", reason="concurrent_caption")
+                duplicates.append(existing["_id"])
+        return duplicates
+
+    def backfill_fingerprints(self):
+        # Documents stored before the LSH fingerprints were introduced get them added once
+        for existing in self.captions_collection.find({"caption_lsh": {"$exists": False}, "caption": {"$type": "string"}}, {"caption": 1}):
+            self.captions_collection.update_one(
+                {"_id": existing["_id"]},
+                {"$set": {"caption_lsh": caption_fingerprint(existing["caption"])}}
+            )
+
+    def sweep(self, hash_threshold=5, caption_threshold=0.8):
+        # Offline check of the whole history, independent of the horizon. Walks all
+        # documents in scrape order and marks every document that is a duplicate of an
+        # earlier one with duplicate_of. Returns the number of marked documents.
+        hashes = HashIndex(max_distance=hash_threshold)
+        hash_ids = {}
+        captions = CaptionIndex()
+        caption_ids = {}
+        marked = 0
+        projection = {"image_hash": 1, "caption": 1, "caption_lsh": 1, "duplicate_of": 1}
+        # Without the index the server has to sort the whole collection in memory
+        self.captions_collection.create_index([("scrape_time", 1), ("_id", 1)])
+        for doc in self.captions_collection.find({}, projection).sort([("scrape_time", 1), ("_id", 1)]):
+            if doc.get("duplicate_of"):
+                continue
+            original = None
+            value = None
+            if doc.get("image_hash"):
+                try:
+                    value = HashIndex.to_int(doc["image_hash"])
+                    match = hashes.find_within(doc["image_hash"], hash_threshold)
+                    original = hash_ids[match[0]] if match is not None else None
+                except ValueError:
+                    value = None
+            caption = (doc.get("caption") or "").lower()
+            caption_keys = doc.get("caption_lsh") or caption_fingerprint(caption)
+            if original is None and caption:
+                for candidate in captions.candidates(caption_keys):
+                    if length_compatible(len(caption), len(candidate), caption_threshold) and \
+                            Levenshtein.ratio(caption, candidate) >= caption_threshold:
+                        original = caption_ids[candidate]
+                        break
+            if original is not None:
+                self.captions_collection.update_one({"_id": doc["_id"]}, {"$set": {"duplicate_of": original}})
+                marked += 1
+                continue
+            if value is not None and value not in hash_ids:
+                hashes.add_value(value)
+                hash_ids[value] = doc["_id"]
+            if caption and caption not in caption_ids:
+                captions.add(caption, caption_keys)
+                caption_ids[caption] = doc["_id"]
+        metrics.inc("duplicates_marked_total", marked)
+        return marked
+
     def close_connection(self):
-        self.client.close()
+        self.hash_index.save()
+        if self.owns_client:
+            self.client.close()
+
+def sweep(db_name, client_address):
+    # Full history check, meant to run periodically next to the pipeline (e.g. from cron)
+    duplicate_checker = CheckDuplicate(db_name, client_address)
+    try:
+        marked = duplicate_checker.sweep()
+        print(f"Marked {marked} duplicates.")
+    finally:
+        duplicate_checker.close_connection()
 
 def main():
-    
-    if len(sys.argv) != 4:
-        print("Usage: python3 check_duplicate.py <scraped_data.json>", file=sys.stderr)
+    if len(sys.argv) == 4 and sys.argv[1] == "--sweep":
+        sweep(sys.argv[2], sys.argv[3])
+        return
+    if len(sys.argv) not in (4, 5, 6):
+        print("Usage: python3 check_duplicate.py <scraped_data.jsonl|-> <db_name> <client_address> [hash_index_file] [output.jsonl|-]", file=sys.stderr)
+        print("       python3 check_duplicate.py --sweep <db_name> <client_address>", file=sys.stderr)
         sys.exit(1)
     
+    # The input is streamed, "-" reads from stdin and writes the result to stdout
     input_file = sys.argv[1]
-    try:
-        with open(input_file, 'r') as f:
-            scraped_data = json.load(f)
-    except Exception as e:
-        print(f"Error reading input data: {e}", file=sys.stderr)
-        sys.exit(1)
-    
+    scraped_data = read_records(input_file)
 
     # Load configuration to get the database name.
     db_name = sys.argv[2]
     client_address = sys.argv[3]
-
+    hash_index_file = sys.argv[4] if len(sys.argv) >= 5 and sys.argv[4] else None
+    output_file = sys.argv[5] if len(sys.argv) == 6 else input_file
 
     # Check if the database and collection exist.
     client = MongoClient(client_address)
+    duplicate_checker = None
     if db_name not in client.list_database_names():
         print(f"Database '{db_name}' does not exist. Skipping duplicate check.", file=sys.stderr)
         filtered_data = scraped_data
     else:
         # Check for duplicates.
-        duplicate_checker = CheckDuplicate(db_name, client_address)
-        filtered_data = duplicate_checker.remove_duplicates(scraped_data)
-        duplicate_checker.close_connection()
-
+        duplicate_checker = CheckDuplicate(db_name, client_address, hash_index=HashIndex(hash_index_file))
+        duplicate_checker.backfill_fingerprints()
+        filtered_data = duplicate_checker.iter_unique(scraped_data)
 
-    # Save the filtered data to a new file.
-    
-    with open(input_file, 'w') as f:
-        json.dump(filtered_data, f, indent=2, default=str)
+    # Save the filtered data, the input file is replaced once everything is written.
+    try:
+        write_records(filtered_data, output_file)
+    except Exception as e:
+        print(f"Error processing input data: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if duplicate_checker is not None:
+            duplicate_checker.close_connection()
+        client.close()
 
 
 if __name__ == '__main__':
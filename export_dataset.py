@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import json
+import tarfile
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import gridfs
+from bson import ObjectId
+from pymongo import MongoClient
+
+import metrics
+
+# Exports the captions and their images as WebDataset shards: tar files with the files
+# <key>.<ext>, <key>.txt and <key>.json for every sample. The captions are read in
+# (created_at, _id) order and the position of the last exported document is kept in a
+# watermark file, so every export only adds the documents stored since the last one.
+# created_at is set when the document is written. scrape_time can be much older, e.g.
+# for the items of a resumed run, and would let those slip behind the watermark.
+
+WATERMARK_FILE = "watermark.json"
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF8", "gif"),
+    (b"RIFF", "webp"),
+    (b"BM", "bmp"),
+)
+
+
+def image_extension(data):
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    return "img"
+
+
+def load_watermark(output_dir):
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {"created_at": None, "_id": None, "shards": 0, "samples": 0}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_watermark(output_dir, watermark):
+    path = os.path.join(output_dir, WATERMARK_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(watermark, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def prefetch(pool, fn, items, depth):
+    # Like pool.map, but only keeps `depth` calls in flight and yields in input order
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class DatasetExporter:
+    def __init__(self, db_name, client_address=None, client=None, output_dir="dataset",
+                 shard_size=1000, workers=16, settle_seconds=300):
+        self.owns_client = client is None
+        self.client = client if client is not None else MongoClient(client_address)
+        self.db = self.client[db_name]
+        self.fs = gridfs.GridFS(self.db, collection='images')
+        self.captions_collection = self.db['captions']
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.workers = workers
+        # Documents stored in the last settle_seconds are left for the next export. Writers
+        # on other machines with a slightly late clock may still insert older created_at values.
+        self.settle_seconds = settle_seconds
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Export order, so resuming from the watermark is a range scan
+        self.captions_collection.create_index([('created_at', 1), ('_id', 1)])
+
+    def resolve_watermark(self, watermark):
+        # Watermarks of older versions only have the scrape_time, the created_at of their
+        # last document is looked up once
+        if "created_at" not in watermark:
+            last_doc = None
+            if watermark.get("_id"):
+                last_doc = self.captions_collection.find_one({'_id': ObjectId(watermark["_id"])}, {'created_at': 1})
+            watermark["created_at"] = last_doc['created_at'].isoformat() if last_doc else None
+            watermark.pop("scrape_time", None)
+        return watermark
+
+    def query(self, watermark):
+        # Documents marked by the duplicate sweep are left out
+        conditions = [{'created_at': {'$lt': datetime.now() - timedelta(seconds=self.settle_seconds)}},
+                      {'duplicate_of': {'$exists': False}}]
+        if watermark["created_at"] is not None:
+            created_at = datetime.fromisoformat(watermark["created_at"])
+            last_id = ObjectId(watermark["_id"])
+            conditions.append({'$or': [
+                {'created_at': {'$gt': created_at}},
+                {'created_at': created_at, '_id': {'$gt': last_id}},
+            ]})
+        return {'$and': conditions}
+
+    def iter_documents(self, watermark):
+        cursor = self.captions_collection.find(self.query(watermark), {'caption_lsh': False})
+        return cursor.sort([('created_at', 1), ('_id', 1)]).batch_size(self.shard_size)
+
+    def load_sample(self, doc):
+        # Runs in the prefetch pool, the image is None if it is not in GridFS anymore
+        try:
+            image_data = self.fs.get(doc['image_id']).read()
+        except gridfs.errors.NoFile:
+            metrics.inc("export_missing_images_total")
+            return doc, None
+        return doc, image_data
+
+    def export(self):
+        # Returns the number of exported samples
+        watermark = self.resolve_watermark(load_watermark(self.output_dir))
+        exported = 0
+        shard = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            samples = prefetch(pool, self.load_sample, self.iter_documents(watermark), self.workers * 4)
+            for doc, image_data in samples:
+                shard.append((doc, image_data))
+                if len(shard) >= self.shard_size:
+                    exported += self.write_shard(shard, watermark)
+                    shard = []
+            if shard:
+                exported += self.write_shard(shard, watermark)
+        return exported
+
+    def write_shard(self, shard, watermark):
+        # The shard is renamed into place before the watermark moves past its documents,
+        # so an interrupted export is repeated from the last complete shard
+        path = os.path.join(self.output_dir, f"shard-{watermark['shards']:06d}.tar")
+        tmp_path = f"{path}.tmp"
+        count = 0
+        with metrics.timer("stage_seconds", stage="ExportShard"), tarfile.open(tmp_path, "w") as tar:
+            for doc, image_data in shard:
+                if image_data is None:
+                    continue
+                key = str(doc['_id'])
+                add_file(tar, f"{key}.{image_extension(image_data)}", image_data)
+                add_file(tar, f"{key}.txt", (doc.get('caption') or "").encode())
+                add_file(tar, f"{key}.json", json.dumps(sample_metadata(doc), default=str).encode())
+                count += 1
+        os.replace(tmp_path, path)
+
+        last_doc = shard[-1][0]
+        watermark.update({
+            "created_at": last_doc['created_at'].isoformat(),
+            "_id": str(last_doc['_id']),
+            "shards": watermark["shards"] + 1,
+            "samples": watermark["samples"] + count,
+        })
+        save_watermark(self.output_dir, watermark)
+        metrics.inc("export_samples_total", count)
+        print(f"Wrote {path} with {count} samples.", file=sys.stderr)
+        return count
+
+    def close(self):
+        if self.owns_client:
+            self.client.close()
+
+
+def sample_metadata(doc):
+    return {
+        "id": str(doc['_id']),
+        "caption_url": doc.get('caption_url'),
+        "image_url": doc.get('image_url'),
+        "scrape_time": doc.get('scrape_time'),
+        "image_hash": doc.get('image_hash'),
+        "image_id": str(doc['image_id']),
+    }
+
+
+def add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export captions and images as WebDataset tar shards")
+    parser.add_argument("db_name")
+    parser.add_argument("client_address")
+    parser.add_argument("output_dir")
+    parser.add_argument("--shard-size", type=int, default=1000, help="Samples per shard")
+    parser.add_argument("--workers", type=int, default=16, help="Parallel GridFS reads")
+    parser.add_argument("--settle", type=float, default=300,
+                        help="Leave documents stored in the last SETTLE seconds for the next export")
+    args = parser.parse_args()
+
+    exporter = DatasetExporter(args.db_name, args.client_address, output_dir=args.output_dir,
+                               shard_size=args.shard_size, workers=args.workers, settle_seconds=args.settle)
+    try:
+        exported = exporter.export()
+    except Exception as e:
+        print(f"Error exporting the dataset: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        exporter.close()
+    print(f"Exported {exported} samples to {args.output_dir}.")
+
+
+if __name__ == "__main__":
+    main()
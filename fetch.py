@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+import metrics
+from rate_limit import request_slot
+
+# urllib3 only decodes brotli if one of the brotli packages is installed
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(requests.exceptions.RequestException):
+    pass
+
+
+class ResponseTooLarge(FetchError):
+    pass
+
+
+class UnexpectedContentType(FetchError):
+    pass
+
+
+class FetchResponse:
+    # The fully read body together with status and headers of the response
+    def __init__(self, response, content):
+        self.response = response
+        self.url = response.url
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = content
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+
+class HostStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def to_dict(self):
+        return {"count": self.count, "mean_seconds": self.total / self.count if self.count else None,
+                "max_seconds": self.max}
+
+
+class Fetcher:
+    # The HTTP client of all stages: pooled keep-alive connections, connect/read timeouts,
+    # retries with exponential backoff and jitter, and streamed downloads with a size cap.
+    def __init__(self, connect_timeout=5, read_timeout=10, retries=3, backoff=0.5, max_backoff=10,
+                 max_bytes=20 * 1024 * 1024, max_image_bytes=10 * 1024 * 1024, pool_maxsize=32,
+                 limiter=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_bytes = max_bytes
+        self.max_image_bytes = max_image_bytes
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def get(self, url, headers=None, max_bytes=None, content_types=None):
+        # content_types is a tuple of allowed Content-Type prefixes, e.g. ("image/",)
+        attempt = 0
+        while True:
+            try:
+                response = self.request(url, headers, max_bytes or self.max_bytes, content_types)
+                if response.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return response
+                delay = self.retry_after(response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.retries:
+                    raise
+                delay = None
+            metrics.inc("http_retries_total")
+            time.sleep(delay if delay is not None else self.backoff_delay(attempt))
+            attempt += 1
+
+    def get_image(self, url, headers=None):
+        return self.get(url, headers, max_bytes=self.max_image_bytes, content_types=("image/",))
+
+    def request(self, url, headers, max_bytes, content_types):
+        with request_slot(self.limiter, url):
+            start = time.perf_counter()
+            response = self.session.get(url, headers=headers, timeout=self.timeout, stream=True)
+            try:
+                if response.status_code == 200:
+                    self.check_content_type(url, response, content_types)
+                content = self.read_capped(url, response, max_bytes)
+            finally:
+                response.close()
+            seconds = time.perf_counter() - start
+        self.record(url, seconds, len(content))
+        return FetchResponse(response, content)
+
+    def check_content_type(self, url, response, content_types):
+        content_type = response.headers.get("Content-Type")
+        if content_types and content_type and not content_type.lower().startswith(content_types):
+            raise UnexpectedContentType(f"Unexpected Content-Type {content_type} for {url}")
+
+    def read_capped(self, url, response, max_bytes):
+        # Aborts as soon as the (decompressed) body gets larger than max_bytes
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ResponseTooLarge(f"{url} is {length} bytes, the limit is {max_bytes}")
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                metrics.inc("http_aborted_too_large_total")
+                raise ResponseTooLarge(f"{url} is larger than {max_bytes} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if value and value.isdigit():
+            return min(int(value), self.max_backoff)
+        return None
+
+    def backoff_delay(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def record(self, url, seconds, size):
+        host = urlparse(url).hostname or ""
+        with self.stats_lock:
+            stats = self.stats.setdefault(host, HostStats())
+            stats.count += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+        metrics.record_http(url, seconds, size)
+
+    def host_stats(self):
+        with self.stats_lock:
+            return {host: stats.to_dict() for host, stats in self.stats.items()}
+
+    def close(self):
+        self.session.close()
@@ -1,36 +1,95 @@
 #!/usr/bin/env python3
 import sys
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from html_parsing import parse_html
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import metrics
 from datetime import datetime
 import json
 import base64
-import io
-import imagehash
-from PIL import Image
+from image_hashing import compute_phash, DECODE_ERRORS
+from blob_cache import content_digest
+from record_stream import write_records
+from fetch import Fetcher
 
 class FindPicCaption:
-    def __init__(self, url, top_tag_name, img_tag_1, cap_tag, img_tag_2=None, img_tag_3=None):
+    def __init__(self, url, top_tag_name, img_tag_1, cap_tag, img_tag_2=None, img_tag_3=None,
+                 max_workers=16, max_per_host=4, blob_cache=None, http_cache=None,
+                 seen_set=None, hash_pool=None, fetcher=None):
         self.url = url
         self.top_tag_name = top_tag_name
         self.img_tag_1 = img_tag_1
         self.img_tag_2 = img_tag_2
         self.img_tag_3 = img_tag_3
         self.cap_tag = cap_tag
+        # Limits for the concurrent image downloads
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        # Optional cache so the storage module can reuse the downloaded bytes
+        self.blob_cache = blob_cache
+        # With a cache the subpage is requested conditionally, not_modified is set on a 304
+        self.http_cache = http_cache
+        self.not_modified = False
+        # Articles already scraped in an earlier run are skipped before the image download
+        self.seen_set = seen_set
+        # Process pool for decoding and hashing, without one the hash is computed in the download thread
+        self.hash_pool = hash_pool
+        # Shared HTTP client with timeouts, retries and size limits
+        self.fetcher = fetcher or Fetcher()
+        self.host_slots = {}
+        self.host_slots_lock = threading.Lock()
+        # Number of images that failed to download, these articles should be tried again
+        self.failed_downloads = 0
 
     def get_articles(self):
-        data_list = []
+        return list(self.iter_articles())
 
+    def iter_articles(self):
+        # Yields the articles in page order while the later images are still downloading
+        candidates = self.get_candidates()
+
+        # Download and hash the images concurrently. map() keeps the article order.
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for result in pool.map(self.fetch_image, candidates):
+                if result is not None:
+                    yield result
+
+    def get_candidates(self):
+        # (full_img_url, caption_url, caption) of the articles on the subpage that were not
+        # scraped before. Nothing is downloaded except the subpage itself.
         try:
-            response = requests.get(self.url)
-            response.raise_for_status()
-            html_content = response.content
+            if self.http_cache is not None:
+                html_content, self.not_modified = self.http_cache.fetch(self.url)
+            else:
+                response = self.fetcher.get(self.url)
+                response.raise_for_status()
+                html_content = response.content
+            if self.not_modified:
+                # Nothing changed since the last run
+                return []
         except requests.exceptions.RequestException as e:
             print(f"Error retrieving URL: {e}", file=sys.stderr)
-            return data_list
-
-        soup = BeautifulSoup(html_content, "html.parser")
+            return []
+
+        with metrics.timer("stage_seconds", stage="parse_subpage"):
+            candidates = self.find_candidates(html_content)
+        metrics.inc("articles_found_total", len(candidates))
+        if self.seen_set is not None:
+            candidates_before = candidates
+            candidates = [
+                (full_img_url, caption_url, caption)
+                for full_img_url, caption_url, caption in candidates
+                if full_img_url not in self.seen_set and caption_url not in self.seen_set
+            ]
+            metrics.inc("articles_already_seen_total", len(candidates_before) - len(candidates))
+        return candidates
+
+    def find_candidates(self, html_content):
+        candidates = []
+        # Only the article tags are parsed into the tree
+        soup = parse_html(html_content, only=self.top_tag_name)
 
         # First find all articles with the top tag name 
         articles = soup.find_all(self.top_tag_name)
@@ -66,27 +125,79 @@ class FindPicCaption:
                 continue  # Skip if no image or caption found
 
             full_img_url = urljoin(self.url, image_url)
-
-        # Skip this article if image download fails
-            try:
-                img_response = requests.get(full_img_url)
-                img_response.raise_for_status()
-                img_data = img_response.content
+            candidates.append((full_img_url, caption_url, caption))
+        return candidates
+
+    def host_slot(self, url):
+        # One semaphore per host so a single server never gets more than max_per_host requests
+        host = urlparse(url).netloc
+        with self.host_slots_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.Semaphore(self.max_per_host)
+            return self.host_slots[host]
+
+    def fetch_image(self, candidate):
+        # Returns None if the image could not be downloaded or decoded, the article is skipped
+        try:
+            return self.download_image(candidate)
+        except requests.exceptions.RequestException:
+            with self.host_slots_lock:
+                self.failed_downloads += 1
+            return None
+        except DECODE_ERRORS:
+            return None
+
+    def download_image(self, candidate):
+        # Like fetch_image, but raises the download or decode error
+        full_img_url, caption_url, caption = candidate
+        try:
+            # Aborts on oversized downloads and on responses that are not images
+            with self.host_slot(full_img_url):
+                img_response = self.fetcher.get_image(full_img_url)
+            img_response.raise_for_status()
+            img_data = img_response.content
         # Compute hash and store it 
-                img = Image.open(io.BytesIO(img_data))
-                image_hash = imagehash.phash(img)
-            except requests.exceptions.RequestException:
-                continue  
-
-            scrape_time = datetime.now()
-
-        # Store the data if successful up to here and then start with the next article 
-            data_list.append((full_img_url, caption_url, image_hash, caption, scrape_time))
-        return data_list
+            with metrics.timer("image_hash_seconds"):
+                if self.hash_pool is not None:
+                    image_hash = self.hash_pool.submit(compute_phash, img_data).result()
+                else:
+                    image_hash = compute_phash(img_data)
+        except requests.exceptions.RequestException:
+            metrics.inc("image_download_errors_total")
+            raise
+        except DECODE_ERRORS:
+            # Not an image, a broken one or a decompression bomb
+            metrics.inc("image_decode_errors_total")
+            raise
+        metrics.inc("images_hashed_total")
+        metrics.observe("image_bytes", len(img_data), metrics.SIZE_BUCKETS)
+
+        if self.blob_cache is not None:
+            image_digest = self.blob_cache.put(img_data)
+        else:
+            image_digest = content_digest(img_data)
+
+        scrape_time = datetime.now()
+        return (full_img_url, caption_url, image_hash, caption, scrape_time, image_digest)
+
+def to_record(article):
+    # Convert an article tuple into a JSON serializable record for the later stages.
+    full_img_url, caption_url, img_hash, caption, scrape_time, image_digest = article
+    return {
+        "full_img_url": full_img_url,
+        "caption_url": caption_url,
+        "caption": caption,
+        "image_hash": img_hash.__str__(),
+        "scrape_time": scrape_time.isoformat(),
+        "image_digest": image_digest,
+    }
+
+def to_records(articles):
+    return [to_record(article) for article in articles]
 
 def main():
     if len(sys.argv) < 5:
-        print("Usage: python find_pic_caption.py <url> <top_tag_name> <img_tag_1> <cap_tag> [img_tag_2] [img_tag_3]", file=sys.stderr)
+        print("Usage: python find_pic_caption.py <url> <top_tag_name> <img_tag_1> <cap_tag> [img_tag_2] [img_tag_3] [output.jsonl|-]", file=sys.stderr)
         sys.exit(1)
 
     url = sys.argv[1]
@@ -95,28 +206,12 @@ def main():
     cap_tag = sys.argv[4]
     img_tag_2 = sys.argv[5] if len(sys.argv) >= 6 else None
     img_tag_3 = sys.argv[6] if len(sys.argv) >= 7 else None
+    scraped_data_file = sys.argv[7] if len(sys.argv) >= 8 else "scraped_data.jsonl"
+
+    articles = FindPicCaption(url, top_tag_name, img_tag_1, cap_tag, img_tag_2, img_tag_3).iter_articles()
 
-    articles = FindPicCaption(url, top_tag_name, img_tag_1, cap_tag, img_tag_2, img_tag_3).get_articles()
-
-
-    # Prepare the output list by converting non-serializable types to strings.
-    output = []
-    for article in articles:
-        full_img_url, caption_url, img_hash, caption, scrape_time = article
-        entry = {
-            "full_img_url": full_img_url,
-            "caption_url": caption_url,
-            "caption": caption,
-            "image_hash": img_hash.__str__(),
-            "scrape_time": scrape_time.isoformat(),
-        }
-        output.append(entry)
-    
-    # Save extracted data to a JSON file
-    scraped_data_file = "scraped_data.json"
-    store = json.dumps(output, indent=2)
-    with open(scraped_data_file, "w") as f:
-        f.write(store)
+    # Save extracted data as JSON lines, one record per article as soon as it is ready
+    write_records((to_record(article) for article in articles), scraped_data_file)
 
 
 if __name__ == "__main__":
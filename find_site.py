@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 import sys
 import requests
+from fetch import Fetcher
 
 class FindSite:
-    def __init__(self, website_url):
+    def __init__(self, website_url, http_cache=None, fetcher=None):
         self.url = website_url
+        # With a cache the page is requested conditionally, not_modified is set on a 304
+        self.http_cache = http_cache
+        self.not_modified = False
+        self.fetcher = fetcher or Fetcher()
 
     def get_html(self):
         try:
-            response = requests.get(self.url)
+            if self.http_cache is not None:
+                content, self.not_modified = self.http_cache.fetch(self.url)
+                return content
+            response = self.fetcher.get(self.url)
             response.raise_for_status()  # Raises an error for bad status codes
             return response.content
         except requests.exceptions.RequestException as e:
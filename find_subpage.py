@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from bs4 import BeautifulSoup
+from html_parsing import parse_html
 from urllib.parse import urljoin
 import sys
 
@@ -9,17 +9,18 @@ class FindSubPage:
         self.html = html
 
     def get_url(self):
-        soup = BeautifulSoup(self.html, "html.parser")
+        # Only the links and the base tag are needed
+        soup = parse_html(self.html, only=["a", "base"])
         links = soup.find_all('a')
-        
+        base_tag = soup.find("base")
+        base_url = base_tag.get("href") if base_tag else ""
+
         for link in links:
             # Look for the keyword in the text of the link
             if self.keyword in link.get_text(strip=True):
                 sub_link = link.get('href')
                 if not sub_link:
                     continue
-                base_tag = soup.find("base")
-                base_url = base_tag.get("href") if base_tag else ""
                 full_link = urljoin(base_url, sub_link)  # Join base URL and relative link
                 return full_link
         return None
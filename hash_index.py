@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+import os
+import json
+import struct
+from datetime import datetime
+from bson import ObjectId
+import metrics
+
+# Every stored entry is the hash and the time (unix seconds) it was last scraped
+ENTRY = struct.Struct("<Qq")
+FORMAT_VERSION = 2
+
+
+def entry_time(doc):
+    # Scrape time of a caption document, the insert time for documents without one
+    scrape_time = doc.get("scrape_time")
+    if isinstance(scrape_time, datetime):
+        return int(scrape_time.timestamp())
+    if isinstance(scrape_time, str):
+        try:
+            return int(datetime.fromisoformat(scrape_time).timestamp())
+        except ValueError:
+            pass
+    return int(doc["_id"].generation_time.timestamp())
+
+
+def make_chunks(count, hash_bits=64):
+    # (shift, mask) for every chunk, the bits are spread as evenly as possible
+    chunks = []
+    shift = 0
+    for i in range(count):
+        width = hash_bits // count + (1 if i < hash_bits % count else 0)
+        chunks.append((shift, (1 << width) - 1))
+        shift += width
+    return chunks
+
+
+def chunk_keys(image_hash, max_distance=5, hash_bits=64):
+    # The chunks of a hash as strings. They are stored with every caption document, so
+    # any process can look up near duplicates in the database with an indexed $in query.
+    value = HashIndex.to_int(image_hash)
+    return [f"{i}:{(value >> shift) & mask:x}"
+            for i, (shift, mask) in enumerate(make_chunks(max_distance + 1, hash_bits))]
+
+
+class HashIndex:
+    # Multi-index hashing for 64 bit perceptual hashes. Every hash is split into
+    # max_distance + 1 chunks. Two hashes that differ in at most max_distance bits
+    # have at least one identical chunk, so only hashes sharing a chunk have to be compared.
+    # The time of every hash is kept, so hashes older than the dedup horizon can be pruned.
+    def __init__(self, path=None, max_distance=5, hash_bits=64):
+        self.path = path
+        self.max_distance = max_distance
+        self.hash_bits = hash_bits
+        self.chunks = make_chunks(max_distance + 1, hash_bits)
+        self.tables = [{} for _ in self.chunks]
+        self.known = {}
+        self.pending = []
+        self.stored_count = 0
+        self.last_id = None
+        if self.path:
+            self.load()
+
+    @staticmethod
+    def to_int(image_hash):
+        return int(str(image_hash), 16)
+
+    def __len__(self):
+        return len(self.known)
+
+    def add(self, image_hash, time=0):
+        self.add_value(self.to_int(image_hash), time)
+
+    def add_value(self, value, time=0):
+        if value in self.known:
+            if time > self.known[value]:
+                # Seen again, the newer time is appended and wins when the file is loaded
+                self.known[value] = time
+                self.pending.append((value, time))
+            return
+        self.known[value] = time
+        self.pending.append((value, time))
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table.setdefault((value >> shift) & mask, []).append(value)
+
+    def prune(self, before):
+        # Drops the hashes last seen before the unix time `before` and returns their number.
+        # The tables are rebuilt and the whole file is rewritten on the next save.
+        kept = {value: time for value, time in self.known.items() if time >= before}
+        removed = len(self.known) - len(kept)
+        if not removed:
+            return 0
+        self.tables = [{} for _ in self.chunks]
+        self.known = {}
+        self.pending = []
+        self.stored_count = 0
+        for value, time in kept.items():
+            self.add_value(value, time)
+        metrics.inc("hash_index_pruned_total", removed)
+        return removed
+
+    def find_within(self, image_hash, threshold):
+        # Returns (stored_hash, distance) of the first hash within threshold or None
+        value = self.to_int(image_hash)
+        if threshold > self.max_distance:
+            candidates = self.known
+        else:
+            candidates = set()
+            for table, (shift, mask) in zip(self.tables, self.chunks):
+                candidates.update(table.get((value >> shift) & mask, ()))
+        metrics.inc("hash_comparisons_total", len(candidates))
+        for candidate in candidates:
+            distance = bin(value ^ candidate).count("1")
+            if distance <= threshold:
+                return candidate, distance
+        return None
+
+    def sync(self, collection, since=None):
+        # Pull only the documents inserted since the last sync. This relies on the
+        # increasing ObjectIds of a single writer. `since` is the ISO scrape time of the
+        # oldest document that is still of interest.
+        query = {"image_hash": {"$exists": True}}
+        if self.last_id is not None:
+            query["_id"] = {"$gt": self.last_id}
+        if since is not None:
+            query["scrape_time"] = {"$gte": since}
+        for doc in collection.find(query, {"image_hash": 1, "scrape_time": 1}).sort("_id", 1):
+            self.last_id = doc["_id"]
+            try:
+                self.add(doc["image_hash"], entry_time(doc))
+            except (TypeError, ValueError):
+                continue
+
+    def load(self):
+        meta_path = f"{self.path}.meta"
+        if not os.path.exists(meta_path) or not os.path.exists(self.path):
+            return
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("max_distance") != self.max_distance or meta.get("version") != FORMAT_VERSION:
+            # The chunk layout or the file format changed, rebuild from the database
+            return
+        count = meta["count"]
+        with open(self.path, "rb") as f:
+            data = f.read(count * ENTRY.size)
+        for value, time in ENTRY.iter_unpack(data[:len(data) - len(data) % ENTRY.size]):
+            self.add_value(value, time)
+        self.pending = []
+        self.stored_count = len(data) // ENTRY.size
+        if meta.get("last_id") and self.stored_count == count:
+            self.last_id = ObjectId(meta["last_id"])
+
+    def save(self):
+        # Append the new hashes to the packed file and update the sidecar afterwards,
+        # a crash in between only loses the unsaved part.
+        if not self.path:
+            return
+        mode = "r+b" if os.path.exists(self.path) else "wb"
+        with open(self.path, mode) as f:
+            f.seek(self.stored_count * ENTRY.size)
+            f.write(b"".join(ENTRY.pack(value, time) for value, time in self.pending))
+            f.truncate()
+        self.stored_count += len(self.pending)
+        self.pending = []
+        meta = {
+            "version": FORMAT_VERSION,
+            "count": self.stored_count,
+            "max_distance": self.max_distance,
+            "last_id": str(self.last_id) if self.last_id is not None else None,
+        }
+        tmp_path = f"{self.path}.meta.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, f"{self.path}.meta")
@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+from bs4 import BeautifulSoup, SoupStrainer
+
+# lxml is much faster than the built-in parser, fall back to html.parser if it is missing
+try:
+    import lxml  # noqa: F401
+    DEFAULT_PARSER = "lxml"
+except ImportError:
+    DEFAULT_PARSER = "html.parser"
+
+
+def parse_html(html, only=None, parser=None):
+    # only restricts the tree to the given tag name(s) and their children, so large
+    # pages never build the full document tree.
+    parse_only = SoupStrainer(only) if only else None
+    return BeautifulSoup(html, parser or DEFAULT_PARSER, parse_only=parse_only)
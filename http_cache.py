@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import hashlib
+import threading
+import metrics
+from fetch import Fetcher
+
+
+class HttpCache:
+    # Keeps the last body of a page together with its ETag / Last-Modified header, so
+    # the next request can be sent as a conditional GET. Also caches the subpage URL
+    # found for a keyword for ttl seconds.
+    def __init__(self, cache_dir, fetcher=None):
+        self.cache_dir = cache_dir
+        self.fetcher = fetcher or Fetcher()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.mappings_file = os.path.join(self.cache_dir, "mappings.json")
+        # Several sites may update the mappings file at the same time
+        self.mappings_lock = threading.Lock()
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json"), os.path.join(self.cache_dir, f"{key}.body")
+
+    def load_entry(self, url):
+        meta_path, body_path = self.paths(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        return meta, body
+
+    def store_entry(self, url, response):
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched": time.time(),
+        }
+        if not meta["etag"] and not meta["last_modified"]:
+            # Without validators the server can not answer with 304
+            self.forget(url)
+            return
+        meta_path, body_path = self.paths(url)
+        with open(body_path, "wb") as f:
+            f.write(response.content)
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    def forget(self, url):
+        for path in self.paths(url):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def fetch(self, url):
+        # Returns (content, not_modified). Raises requests exceptions like requests.get.
+        meta, body = self.load_entry(url)
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = self.fetcher.get(url, headers=headers)
+        if response.status_code == 304 and body is not None:
+            metrics.inc("http_not_modified_total")
+            return body, True
+        response.raise_for_status()
+        self.store_entry(url, response)
+        return response.content, False
+
+    def load_mappings(self):
+        try:
+            with open(self.mappings_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_mapping(self, key, allow_stale=False):
+        entry = self.load_mappings().get(key)
+        if entry is None:
+            return None
+        if not allow_stale and entry["expires"] < time.time():
+            return None
+        return entry["value"]
+
+    def set_mapping(self, key, value, ttl):
+        with self.mappings_lock:
+            mappings = self.load_mappings()
+            mappings[key] = {"value": value, "expires": time.time() + ttl}
+            tmp_path = f"{self.mappings_file}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(mappings, f)
+            os.replace(tmp_path, self.mappings_file)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import io
+import os
+import imagehash
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+HASH_SIZE = 8
+HIGHFREQ_FACTOR = 4
+# phash only looks at a 32x32 grayscale version. Decoding to at least 4 times that
+# keeps the antialiased resize inside phash close to the one of the full image.
+DECODE_SIZE = HASH_SIZE * HIGHFREQ_FACTOR * 4
+# Raised for broken or non-image data. DecompressionBombError is not an OSError.
+DECODE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+def compute_phash(data, reduced=True):
+    # Returns the phash of the encoded image as hex string, so it is cheap to send between processes
+    img = Image.open(io.BytesIO(data))
+    if reduced:
+        if img.format == "JPEG":
+            # The JPEG decoder scales by 1/2, 1/4 or 1/8 while decoding
+            img.draft("L", (DECODE_SIZE, DECODE_SIZE))
+        if max(img.size) > DECODE_SIZE:
+            img.thumbnail((DECODE_SIZE, DECODE_SIZE))
+    return str(imagehash.phash(img, hash_size=HASH_SIZE, highfreq_factor=HIGHFREQ_FACTOR))
+
+
+def hash_pool(workers=None):
+    # Decoding and hashing is CPU bound, so it runs in one process per core
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count())
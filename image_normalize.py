@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import io
+from PIL import Image, ImageOps
+
+# Re-encoding of the images before they are stored. The functions only take and return
+# bytes, so they can run in the process pool that also computes the hashes.
+
+EXIF_ORIENTATION = 0x0112
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def to_mode(img, image_format):
+    # JPEG has no alpha channel, transparent parts become white
+    if image_format == "JPEG" and img.mode != "RGB":
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            return background
+        return img.convert("RGB")
+    if img.mode not in ("RGB", "RGBA", "L"):
+        return img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+    return img
+
+
+def encode(img, image_format, quality):
+    data = io.BytesIO()
+    if image_format == "PNG":
+        img.save(data, format="PNG", optimize=True)
+    else:
+        img.save(data, format=image_format, quality=quality, optimize=image_format == "JPEG")
+    return data.getvalue()
+
+
+def normalize_image(data, format="JPEG", quality=85, max_size=1600, thumbnail_size=256, thumbnail_quality=75):
+    # Returns (image, thumbnail, info) as encoded bytes. The image is only re-encoded if
+    # that makes it smaller or it has to be resized or converted, otherwise the original
+    # bytes are kept. thumbnail is None if thumbnail_size is not set.
+    image_format = format.upper()
+    img = Image.open(io.BytesIO(data))
+    source_format = img.format
+    too_large = max(img.size) > max_size
+    if too_large and source_format == "JPEG":
+        # The JPEG decoder scales by 1/2, 1/4 or 1/8 while decoding
+        img.draft("RGB", (max_size, max_size))
+    # Apply the EXIF rotation, the re-encoded image has no EXIF data anymore
+    rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+    img = ImageOps.exif_transpose(img)
+    if max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.LANCZOS)
+    img = to_mode(img, image_format)
+
+    image = encode(img, image_format, quality)
+    if not too_large and not rotated and source_format == image_format and len(image) >= len(data):
+        image = data
+    info = {"content_type": CONTENT_TYPES.get(image_format, f"image/{image_format.lower()}"),
+            "width": img.width, "height": img.height}
+
+    thumbnail = None
+    if thumbnail_size:
+        small = img.copy()
+        small.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+        thumbnail = encode(small, image_format, thumbnail_quality)
+    return image, thumbnail, info
@@ -1,14 +1,96 @@
 #!/usr/bin/env python3
-import subprocess
 import sys
 import json
+import time
+import signal
 import logging
+import argparse
+import pstats
+import cProfile
+import threading
+
+from pipeline import Pipeline, PipelineError
+from work_queue import WorkQueue, Coordinator, Worker
+import metrics
+
+class ThreadProfiler:
+    # cProfile only sees the thread it is enabled in. Every thread started while this
+    # profiler is enabled (site producers, image downloads, uploads, queue workers) gets
+    # its own profile through threading.setprofile, they are merged when dumped.
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start_thread(self, *args):
+        # Called on the first event of a new thread, the thread's own profiler replaces this hook
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def enable(self):
+        threading.setprofile(self.start_thread)
+        self.start_thread()
+
+    def dump_stats(self, path):
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+def run_once(run, config):
+    # Returns False if the run failed
+    try:
+        run()
+        return True
+    except PipelineError as e:
+        logging.error(str(e))
+        print(str(e), file=sys.stderr)
+    except Exception as e:
+        logging.exception("Error executing the pipeline")
+        print("Error executing the pipeline:", str(e), file=sys.stderr)
+    finally:
+        if config.get('metrics_file'):
+            metrics.registry.write_json(config['metrics_file'])
+    return False
+
+def stop_on_signal():
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    return stop
+
+def run_daemon(run, pipeline, config, interval):
+    # Polls until SIGINT/SIGTERM. The pipeline keeps its HTTP session, MongoDB client
+    # and duplicate indexes between the polls, so every poll only does the new work.
+    stop = stop_on_signal()
+    logging.info(f"Daemon started, polling every {interval} seconds.")
+    while not stop.is_set():
+        start = time.monotonic()
+        if run_once(run, config):
+            logging.info(f"Poll finished in {time.monotonic() - start:.1f} seconds.")
+            logging.debug(f"HTTP latency per host: {pipeline.fetcher.host_stats()}")
+        metrics.inc("polls_total")
+        stop.wait(max(0, interval - (time.monotonic() - start)))
+    logging.info("Daemon stopped.")
 
 def main():
+    parser = argparse.ArgumentParser(description="Scrape images and captions into MongoDB")
+    parser.add_argument("--profile", metavar="FILE", help="Write a cProfile of the run to FILE")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and poll every poll_interval seconds")
+    parser.add_argument("--interval", type=float, help="Poll interval in seconds, overrides poll_interval")
+    parser.add_argument("--mode", choices=("pipeline", "coordinator", "worker"), default="pipeline",
+                        help="pipeline runs everything in this process, coordinator queues the articles "
+                             "of all sites as jobs in MongoDB and workers process these jobs")
+    args = parser.parse_args()
+
     # Configure logging
     logging.basicConfig(
-        filename='scraper.log', 
-        level=logging.DEBUG,      
+        filename='scraper.log',
+        level=logging.DEBUG,
         format="%(asctime)s - %(levelname)s - %(message)s",  # Log format
         datefmt="%Y-%m-%d %H:%M:%S"
     )
@@ -16,156 +98,58 @@ def main():
     try:
         with open('config.json', 'r') as config_file:
             config = json.load(config_file)
-            website_url = config.get('website_url')
-            keyword = config.get('keyword')
-            top_tag_name = config.get('top_tag_name')
-            img_tag_1 = config.get('img_tag_1')
-            cap_tag = config.get('cap_tag')
-            database_name = config.get('database_name')
-            client_address = config.get('client_adress')
-            scraped_data_file = config.get('scraped_data_file')
-            img_tag_2 = config.get('img_tag_2', None)
-            img_tag_3 = config.get('img_tag_3', None)
-            
+
     except Exception as e:
         logging.exception("Error loading configuration")
         print(f"Error loading configuration: {e}", file=sys.stderr)
         sys.exit(1)
     logging.info("Configuration loaded successfully.")
 
-    # ############################################################################ #
-    #                Module 1 : Extract html_content (find_site.py)                #
-    # ############################################################################ #
-    try:
-        find_site_proc = subprocess.Popen(
-            ['python3', 'find_site.py', website_url],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        html_content, err = find_site_proc.communicate()
-        
-        if find_site_proc.returncode != 0:
-            error_message = err.decode().strip()
-            logging.error(f"Error in find_site.py: {error_message}")
-            print("Error in find_site.py:", err.decode(), file=sys.stderr)
-            sys.exit(find_site_proc.returncode)
-
-    except Exception as e:
-        logging.exception("Error executing find_site.py")
-        print("Error executing find_site.py:", str(e), file=sys.stderr)
-        sys.exit(1)
-    logging.info("HTML content retrieved successfully.")
+    # Optional Prometheus endpoint, /metrics is served while the pipeline runs
+    if config.get('metrics_port'):
+        metrics.registry.serve_prometheus(config['metrics_port'])
 
-    # ############################################################################ #
-    #           Module 2 : Extract subpage subpage_url (find_subpage.py)           #
-    # ############################################################################ #
+    # All modules run in this process. The single scripts (find_site.py, ...) can
+    # still be called on their own for debugging.
     try:
-        find_subpage_proc = subprocess.Popen(
-            ['python3', 'find_subpage.py', keyword],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        subpage_url, err2 = find_subpage_proc.communicate(input=html_content)
-        
-        if find_subpage_proc.returncode != 0:
-            error_message = err2.decode().strip()
-            logging.error(f"Error in find_subpage.py: {error_message}")
-            print("Error in find_subpage.py:", err2.decode(), file=sys.stderr)
-            sys.exit(find_subpage_proc.returncode)
-
+        pipeline = Pipeline(config)
     except Exception as e:
-        print("Error executing find_subpage.py:", str(e), file=sys.stderr)
-        logging.exception("Error executing find_subpage.py")
+        logging.exception("Error setting up the pipeline")
+        print("Error setting up the pipeline:", str(e), file=sys.stderr)
         sys.exit(1)
-    
-    subpage_url = subpage_url.decode().strip()
-    logging.info(f"Subpage URL found: {subpage_url}")
-
-    # ############################################################################ #
-    #        Module 3: Extract image and caption data (find_pic_caption.py)        #
-    # ############################################################################ #
-    cmd = ['python3', 'find_pic_caption.py', subpage_url, top_tag_name, img_tag_1, cap_tag]
-    # Optional image tags if webpage changes format
-    if img_tag_2:
-        cmd.append(img_tag_2)
-    if img_tag_3:
-        cmd.append(img_tag_3)
 
+    # In the job queue mode the coordinator and the workers share the jobs collection
+    run = pipeline.run
+    if args.mode != "pipeline":
+        job_queue = config.get('job_queue', {})
+        work_queue = WorkQueue(pipeline.client[pipeline.database_name],
+                               lease_seconds=job_queue.get('lease_seconds', 120),
+                               max_attempts=job_queue.get('max_attempts', 5),
+                               retry_seconds=job_queue.get('retry_seconds', 30))
+        if args.mode == "coordinator":
+            run = Coordinator(pipeline, work_queue).run
+
+    profiler = ThreadProfiler() if args.profile else None
     try:
-        find_pic_caption_proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        _, err3 = find_pic_caption_proc.communicate()
-        
-        if find_pic_caption_proc.returncode != 0:
-            error_message = err3.decode().strip()
-            logging.error(f"Error in find_pic_caption.py: {error_message}")
-            print("Error in find_pic_caption.py:", err3.decode(), file=sys.stderr)
-            sys.exit(find_pic_caption_proc.returncode)
-
-    except Exception as e:
-        logging.exception("Error executing find_pic_caption.py")
-        print("Error executing find_pic_caption.py:", str(e), file=sys.stderr)
-        sys.exit(1)
-
-    logging.info(f"Scraped data saved ")
-
-     # ############################################################################ #
-     #              Module 5: Check for duplicates (check_duplicate.py)             #
-     # ############################################################################ #
-
-
-    try:
-        check_duplicate_proc = subprocess.Popen(
-            ['python3', 'check_duplicate.py', scraped_data_file, database_name, client_address],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        print ("Checking for duplicates...")
-        out, err4 = check_duplicate_proc.communicate()
-        
-        if check_duplicate_proc.returncode != 0:
-            error_message = err4.decode().strip()
-            logging.error(f"Error in check_duplicate.py: {error_message}")
-            print("Error in check_duplicate.py:", err4.decode(), file=sys.stderr)
-            sys.exit(check_duplicate_proc.returncode)
+        if profiler is not None:
+            profiler.enable()
+        if args.mode == "worker":
+            # Workers run until SIGINT/SIGTERM
+            Worker(pipeline, work_queue, threads=job_queue.get('worker_threads', 4),
+                   poll_seconds=job_queue.get('poll_seconds', 2)).run(stop_on_signal())
+            success = True
+        elif args.daemon:
+            run_daemon(run, pipeline, config, args.interval or config.get('poll_interval', 300))
+            success = True
         else:
-            print(out.decode())
-
-    except Exception as e:
-        logging.exception("Error executing check_duplicate.py")
-        print("Error executing check_duplicate.py:", str(e), file=sys.stderr)
+            success = run_once(run, config)
+    finally:
+        pipeline.close()
+        if profiler is not None:
+            # After pipeline.close(), so the threads of all pools have finished
+            profiler.dump_stats(args.profile)
+    if not success:
         sys.exit(1)
 
-    logging.info("Duplicates checked successfully.")
-
-    # ############################################################################ #
-    #              Module 4: Store data in MongoDB (store_in_mongo.py)             #
-    # ############################################################################ #
-
-    try:
-        store_in_mongo_proc = subprocess.Popen(
-            ['python3', 'store_in_mongo.py', scraped_data_file , database_name, client_address],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        mongo_output, err5 = store_in_mongo_proc.communicate()
-        
-        if store_in_mongo_proc.returncode != 0:
-            error_message = err5.decode().strip()
-            logging.error(f"Error in store_in_mongo.py: {error_message}")
-            print("Error in store_in_mongo.py:", err5.decode(), file=sys.stderr)
-            sys.exit(store_in_mongo_proc.returncode)
-
-    except Exception as e:
-        logging.exception("Error executing store_in_mongo.py")
-        print("Error executing store_in_mongo.py:", str(e), file=sys.stderr)
-        sys.exit(1)
-
-    logging.info("Data stored in MongoDB successfully.")
-
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
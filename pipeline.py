@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+import os
+import queue
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient
+
+from find_site import FindSite
+from find_subpage import FindSubPage
+from find_pic_caption import FindPicCaption, to_record
+from check_duplicate import CheckDuplicate
+from store_in_mongo import StoreInMongo
+from blob_cache import BlobCache
+from hash_index import HashIndex
+from http_cache import HttpCache
+from seen_set import SeenSet
+from run_journal import RunJournal, item_key, SCRAPED, CHECKED, STORED
+from rate_limit import RateLimiter
+from fetch import Fetcher
+from image_hashing import hash_pool
+import metrics
+
+
+class PipelineError(Exception):
+    pass
+
+
+class SiteProfile:
+    # One news source. Keys missing in the profile are taken from the top level of the config.
+    def __init__(self, profile, defaults):
+        self.website_url = profile.get('website_url', defaults.get('website_url'))
+        self.keyword = profile.get('keyword', defaults.get('keyword'))
+        self.top_tag_name = profile.get('top_tag_name', defaults.get('top_tag_name'))
+        self.img_tag_1 = profile.get('img_tag_1', defaults.get('img_tag_1'))
+        self.img_tag_2 = profile.get('img_tag_2', defaults.get('img_tag_2', None))
+        self.img_tag_3 = profile.get('img_tag_3', defaults.get('img_tag_3', None))
+        self.cap_tag = profile.get('cap_tag', defaults.get('cap_tag'))
+        self.name = profile.get('name', self.website_url)
+
+
+def load_sites(config):
+    # Old configs describe a single site on the top level
+    profiles = config.get('sites') or [{}]
+    return [SiteProfile(profile, config) for profile in profiles]
+
+
+# Put into the record queue by a site once it has no more records
+SITE_DONE = object()
+
+
+class Pipeline:
+    # Runs all modules in a single process and passes Python objects between them.
+    # The sites are scraped concurrently, the duplicate check and the storage run in
+    # one consumer so duplicates between the sites are found as well.
+    def __init__(self, config):
+        self.sites = load_sites(config)
+        self.database_name = config.get('database_name')
+        self.image_workers = config.get('image_workers', 16)
+        self.image_workers_per_host = config.get('image_workers_per_host', 4)
+        self.site_workers = config.get('site_workers', 8)
+        self.queue_size = config.get('record_queue_size', 256)
+
+        # Image decoding and hashing run in a process pool sized to the cores
+        self.hash_pool = hash_pool(config.get('hash_workers'))
+
+        # Politeness limits shared by all sites
+        rate_limit = config.get('rate_limit', {})
+        limiter = RateLimiter(max_connections=rate_limit.get('max_connections', 32),
+                              max_per_domain=rate_limit.get('max_per_domain', 4),
+                              requests_per_second=rate_limit.get('requests_per_second'))
+
+        # One HTTP client with a keep-alive connection pool for all requests
+        http = config.get('http', {})
+        self.fetcher = Fetcher(connect_timeout=http.get('connect_timeout', 5),
+                               read_timeout=config.get('request_timeout', 10),
+                               retries=http.get('retries', 3),
+                               backoff=http.get('backoff', 0.5),
+                               max_bytes=http.get('max_page_bytes', 20 * 1024 * 1024),
+                               max_image_bytes=http.get('max_image_bytes', 10 * 1024 * 1024),
+                               pool_maxsize=rate_limit.get('max_connections', 32),
+                               limiter=limiter)
+
+        # Conditional GETs for the front page and subpage, and the cached subpage URL
+        self.http_cache = HttpCache(config.get('http_cache_dir', 'http_cache'), fetcher=self.fetcher)
+        self.subpage_ttl = config.get('subpage_ttl', 3600)
+
+        # Images are only downloaded once and shared between extraction and storage
+        self.blob_cache = BlobCache(config.get('blob_cache_dir', 'blob_cache'),
+                                    config.get('blob_cache_max_bytes', 512 * 1024 * 1024))
+
+        # One client is shared by the duplicate check and the storage module
+        self.client = MongoClient(config.get('client_adress'))
+        hash_index = HashIndex(config.get('hash_index_file', 'hash_index.bin'))
+        self.duplicate_checker = CheckDuplicate(self.database_name, client=self.client, hash_index=hash_index,
+                                                horizon_days=config.get('dedup_horizon_days'),
+                                                horizon_docs=config.get('dedup_horizon_docs'))
+        self.duplicate_checker.backfill_fingerprints()
+        # URLs of articles scraped in earlier runs. A new set is filled from the database once.
+        seen_set_file = config.get('seen_set_file', 'seen_urls.bin')
+        new_seen_set = not os.path.exists(seen_set_file)
+        self.seen_set = SeenSet(seen_set_file)
+        if new_seen_set and config.get('seen_set_sync_mongo', True):
+            self.seen_set.sync(self.client[self.database_name])
+            self.seen_set.save()
+        self.mongo_store = StoreInMongo(self.database_name, client=self.client, blob_cache=self.blob_cache,
+                                        batch_size=config.get('store_batch_size', 100),
+                                        write_concern=config.get('write_concern'),
+                                        upload_workers=config.get('upload_workers', 4),
+                                        fetcher=self.fetcher,
+                                        normalize=config.get('image_normalize'),
+                                        image_pool=self.hash_pool)
+        # Progress of every item, an interrupted run is resumed from here
+        self.journal = RunJournal(config.get('run_journal_file', 'run_journal.sqlite'))
+
+    def find_subpage_url(self, site):
+        mapping_key = f"{site.website_url}|{site.keyword}"
+        subpage_url = self.http_cache.get_mapping(mapping_key)
+        if subpage_url:
+            logging.info(f"{site.name}: Using cached subpage URL: {subpage_url}")
+            return subpage_url
+
+        # ############################################################################ #
+        #                Module 1 : Extract html_content (find_site.py)                #
+        # ############################################################################ #
+        front_page = FindSite(site.website_url, http_cache=self.http_cache, fetcher=self.fetcher)
+        with metrics.timer("stage_seconds", stage="FindSite"):
+            html_content = front_page.get_html()
+        if html_content is None:
+            raise PipelineError(f"Error in find_site: could not retrieve HTML content of {site.website_url}")
+        logging.info(f"{site.name}: HTML content retrieved successfully.")
+
+        # ############################################################################ #
+        #           Module 2 : Extract subpage subpage_url (find_subpage.py)           #
+        # ############################################################################ #
+        if front_page.not_modified:
+            # Same front page as before, so the expired mapping is still correct
+            subpage_url = self.http_cache.get_mapping(mapping_key, allow_stale=True)
+        if not subpage_url:
+            with metrics.timer("stage_seconds", stage="FindSubPage"):
+                subpage_url = FindSubPage(site.keyword, html_content).get_url()
+        if not subpage_url:
+            raise PipelineError(f"Error in find_subpage: No subpage URL found for {site.website_url}.")
+        self.http_cache.set_mapping(mapping_key, subpage_url, self.subpage_ttl)
+        logging.info(f"{site.name}: Subpage URL found: {subpage_url}")
+        return subpage_url
+
+    def scrape_site(self, site, record_queue, stop, subpage_urls):
+        # Producer: puts the records of one site into the queue, returns the error if the site failed
+        subpage_url = None
+        try:
+            subpage_url = self.find_subpage_url(site)
+            subpage_urls.append(subpage_url)
+
+            # ############################################################################ #
+            #        Module 3: Extract image and caption data (find_pic_caption.py)        #
+            # ############################################################################ #
+            pic_caption = FindPicCaption(subpage_url, site.top_tag_name, site.img_tag_1, site.cap_tag,
+                                         site.img_tag_2, site.img_tag_3,
+                                         max_workers=self.image_workers,
+                                         max_per_host=self.image_workers_per_host,
+                                         blob_cache=self.blob_cache,
+                                         http_cache=self.http_cache,
+                                         seen_set=self.seen_set,
+                                         hash_pool=self.hash_pool,
+                                         fetcher=self.fetcher)
+            with metrics.timer("stage_seconds", stage="FindPicCaption"):
+                for article in pic_caption.iter_articles():
+                    if not self.put(record_queue, to_record(article), stop):
+                        break
+            if pic_caption.not_modified:
+                logging.info(f"{site.name}: Subpage not modified since the last run. Nothing to do.")
+            elif pic_caption.failed_downloads:
+                # A 304 on the next run would skip the failed articles until the page changes
+                logging.info(f"{site.name}: {pic_caption.failed_downloads} image downloads failed, "
+                             f"the subpage is fetched again next run.")
+                self.http_cache.forget(subpage_url)
+            return None
+        except Exception as e:
+            logging.exception(f"{site.name}: Error scraping site")
+            metrics.inc("site_errors_total", site=site.name)
+            if subpage_url:
+                # Make sure the next run fetches the subpage again instead of getting a 304
+                self.http_cache.forget(subpage_url)
+            return e
+        finally:
+            self.put(record_queue, SITE_DONE, stop)
+
+    def put(self, record_queue, item, stop):
+        # Blocks while the consumer is busy, gives up once the consumer stopped
+        while not stop.is_set():
+            try:
+                record_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(self, record_queue, producers):
+        remaining = producers
+        while remaining:
+            item = record_queue.get()
+            if item is SITE_DONE:
+                remaining -= 1
+                continue
+            yield item
+
+    def run(self):
+        # Items of an interrupted run continue after their last finished stage. Their URLs
+        # are marked as seen, so the sites do not download and hash them again.
+        resumed_scraped, resumed_checked = [], []
+        if self.journal.start_run():
+            for record in self.journal.known_records():
+                self.seen_set.add(record["full_img_url"])
+                self.seen_set.add(record["caption_url"])
+            resumed_scraped = self.journal.pending(SCRAPED)
+            resumed_checked = self.journal.pending(CHECKED)
+            logging.info(f"Resuming interrupted run: {len(resumed_scraped)} items to check, "
+                         f"{len(resumed_checked)} items to store.")
+            metrics.inc("runs_resumed_total")
+
+        # The record queue is bounded, so memory stays flat while the consumer is busy
+        record_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        subpage_urls = []
+        with metrics.timer("run_seconds"), ThreadPoolExecutor(max_workers=self.site_workers) as pool:
+            futures = [pool.submit(self.scrape_site, site, record_queue, stop, subpage_urls) for site in self.sites]
+            try:
+                records = itertools.chain(resumed_scraped, self.drain(record_queue, len(futures)))
+                stored = self.check_and_store(records, resumed_checked)
+            except Exception:
+                stop.set()
+                # Make sure the next run fetches the subpages again instead of getting a 304
+                for subpage_url in subpage_urls:
+                    self.http_cache.forget(subpage_url)
+                raise
+        errors = [future.result() for future in futures if future.result() is not None]
+        if errors and len(errors) == len(futures):
+            raise PipelineError(str(errors[0]))
+        self.journal.finish_run()
+        return stored
+
+    def check_and_store(self, records, checked=()):
+        # The stages are chained generators, every record is passed on as soon as it is ready.
+        # `checked` are records that passed the duplicate check in an interrupted run.
+        scraped_items = []
+        scraped_data = self.track(records, scraped_items)
+        checked = self.track(checked, scraped_items)
+
+        # ############################################################################ #
+        #              Module 4: Check for duplicates (check_duplicate.py)             #
+        # ############################################################################ #
+        print("Checking for duplicates...")
+        if self.database_name not in self.client.list_database_names():
+            logging.info(f"Database '{self.database_name}' does not exist. Skipping duplicate check.")
+            filtered_data = itertools.chain(checked, scraped_data)
+        else:
+            filtered_data = self.duplicate_checker.iter_unique(scraped_data, checked=checked)
+        filtered_data = self.advance(filtered_data, CHECKED)
+
+        # ############################################################################ #
+        #              Module 5: Store data in MongoDB (store_in_mongo.py)             #
+        # ############################################################################ #
+        unique_items = []
+        stored_items = []
+
+        def on_batch(batch):
+            self.journal.advance(batch, STORED)
+            stored_items.extend((item["full_img_url"], item["caption_url"], item["image_digest"]) for item in batch)
+
+        self.mongo_store.insert_data(self.track(filtered_data, unique_items), on_batch=on_batch)
+        logging.info(f"Scraped {len(scraped_items)} articles")
+        logging.info("Duplicates checked successfully.")
+        logging.info(f"Data stored in MongoDB successfully. {len(stored_items)} new articles.")
+
+        # The cached images of this run are not needed anymore. Stored articles and
+        # duplicates are both skipped from now on, articles whose image could not be
+        # stored are scraped again.
+        not_stored = set(unique_items).difference(stored_items)
+        for full_img_url, caption_url, image_digest in scraped_items:
+            self.blob_cache.discard(image_digest)
+            if (full_img_url, caption_url, image_digest) not in not_stored:
+                self.seen_set.add(full_img_url)
+                self.seen_set.add(caption_url)
+        self.seen_set.save()
+        # Keep the persisted hash index current, the in-memory index stays warm for the next poll
+        self.duplicate_checker.hash_index.save()
+        return len(stored_items)
+
+    def track(self, records, keys):
+        # Passes the records through and remembers their URLs and image digest. New
+        # records get their item key and are written to the journal.
+        for record in records:
+            if "item_key" not in record:
+                record["item_key"] = item_key(record)
+                self.journal.scraped(record)
+            keys.append((record["full_img_url"], record["caption_url"], record["image_digest"]))
+            yield record
+
+    def advance(self, records, stage):
+        for record in records:
+            self.journal.advance([record], stage)
+            yield record
+
+    def close(self):
+        self.duplicate_checker.close_connection()
+        self.mongo_store.close_connection()
+        self.hash_pool.shutdown()
+        self.fetcher.close()
+        self.client.close()
+        self.journal.close()
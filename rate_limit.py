@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse
+
+
+class DomainState:
+    def __init__(self, max_per_domain):
+        self.semaphore = threading.Semaphore(max_per_domain)
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+
+class RateLimiter:
+    # Politeness limits shared by all sites of a run: a global connection budget, a
+    # concurrency limit per domain and a minimum interval between requests to a domain.
+    def __init__(self, max_connections=32, max_per_domain=4, requests_per_second=None):
+        self.connections = threading.Semaphore(max_connections)
+        self.max_per_domain = max_per_domain
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.domains = {}
+        self.domains_lock = threading.Lock()
+
+    def domain(self, url):
+        host = urlparse(url).hostname or ""
+        with self.domains_lock:
+            if host not in self.domains:
+                self.domains[host] = DomainState(self.max_per_domain)
+            return self.domains[host]
+
+    def wait_turn(self, state):
+        if not self.interval:
+            return
+        with state.lock:
+            now = time.monotonic()
+            start = max(now, state.next_time)
+            state.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    @contextmanager
+    def slot(self, url):
+        # The domain slot is taken first, so waiting for a slow domain never blocks the global budget
+        state = self.domain(url)
+        with state.semaphore:
+            self.wait_turn(state)
+            with self.connections:
+                yield
+
+
+def request_slot(limiter, url):
+    return limiter.slot(url) if limiter is not None else nullcontext()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+
+# Records are handed between the stages as newline delimited JSON, one record per
+# line. "-" stands for stdin / stdout so the scripts can be piped into each other.
+
+
+def read_records(path):
+    if path == "-":
+        yield from parse_lines(sys.stdin)
+        return
+    with open(path, "r") as f:
+        # Files written before the switch to JSON lines contain one JSON array
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        if first == "[":
+            f.seek(0)
+            yield from json.load(f)
+            return
+        f.seek(0)
+        yield from parse_lines(f)
+
+
+def parse_lines(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def write_records(records, path):
+    # Returns the number of written records. Files are written next to the target and
+    # renamed at the end, so an input file can be rewritten while it is being read.
+    if path == "-":
+        # Flush every record so the next stage can start right away
+        return dump_lines(records, sys.stdout, flush=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        count = dump_lines(records, f)
+    os.replace(tmp_path, path)
+    return count
+
+
+def dump_lines(records, f, flush=False):
+    count = 0
+    for record in records:
+        f.write(json.dumps(record, separators=(",", ":"), default=str))
+        f.write("\n")
+        if flush:
+            f.flush()
+        count += 1
+    return count
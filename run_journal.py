@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import json
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+from seen_set import normalize_url
+
+# Journal of the pipeline runs in a local SQLite file. Every scraped item is recorded
+# under a key derived from its URLs together with the last stage it finished:
+#   scraped -> checked (passed the duplicate check) -> stored
+# A run that did not finish is resumed by the next one, its items continue at the
+# stage after the recorded one instead of being downloaded and hashed again.
+
+SCRAPED = "scraped"
+CHECKED = "checked"
+STORED = "stored"
+
+
+def item_key(record):
+    # Same article and image give the same key, in every run and every process
+    urls = f"{normalize_url(record.get('caption_url') or '')}|{normalize_url(record.get('full_img_url') or '')}"
+    return hashlib.blake2b(urls.encode(), digest_size=16).hexdigest()
+
+
+class RunJournal:
+    def __init__(self, path="run_journal.sqlite"):
+        self.path = path
+        # The consumer thread writes, the lock only guards against accidental sharing
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS runs ("
+                        "run_id INTEGER PRIMARY KEY AUTOINCREMENT, started TEXT, finished TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items ("
+                        "run_id INTEGER, item_key TEXT, stage TEXT, record TEXT, "
+                        "PRIMARY KEY (run_id, item_key))")
+        self.db.commit()
+        self.run_id = None
+
+    def start_run(self):
+        # Continues the last unfinished run or starts a new one. Returns True when resuming.
+        with self.lock:
+            row = self.db.execute("SELECT run_id FROM runs WHERE finished IS NULL "
+                                  "ORDER BY run_id DESC LIMIT 1").fetchone()
+            if row is not None:
+                self.run_id = row[0]
+                return True
+            cursor = self.db.execute("INSERT INTO runs (started) VALUES (?)", (datetime.now().isoformat(),))
+            self.db.commit()
+            self.run_id = cursor.lastrowid
+            return False
+
+    def pending(self, stage):
+        # Records of the current run whose last finished stage is `stage`
+        with self.lock:
+            rows = self.db.execute("SELECT record FROM items WHERE run_id = ? AND stage = ?",
+                                   (self.run_id, stage)).fetchall()
+        return [json.loads(record) for (record,) in rows]
+
+    def known_records(self):
+        # All records of the current run, whatever stage they reached
+        with self.lock:
+            rows = self.db.execute("SELECT record FROM items WHERE run_id = ?", (self.run_id,)).fetchall()
+        return [json.loads(record) for (record,) in rows]
+
+    def scraped(self, record):
+        # Recording an item twice keeps the stage it already reached
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO items (run_id, item_key, stage, record) VALUES (?, ?, ?, ?)",
+                            (self.run_id, record["item_key"], SCRAPED,
+                             json.dumps(record, separators=(",", ":"), default=str)))
+            self.db.commit()
+
+    def advance(self, records, stage):
+        with self.lock:
+            self.db.executemany("UPDATE items SET stage = ? WHERE run_id = ? AND item_key = ?",
+                                [(stage, self.run_id, record["item_key"]) for record in records])
+            self.db.commit()
+
+    def finish_run(self):
+        # The items of a finished run are not needed anymore
+        with self.lock:
+            self.db.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (datetime.now().isoformat(), self.run_id))
+            self.db.execute("DELETE FROM items WHERE run_id = ?", (self.run_id,))
+            self.db.commit()
+            self.run_id = None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import os
+import struct
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    # Lowercase scheme and host, drop default ports and fragments
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    return urlunsplit((scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+class SeenSet:
+    # Set of already scraped URLs. Only 64 bit digests of the normalized URLs are kept,
+    # the file is an append-only list of these digests.
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = set()
+        self.pending = []
+        if self.path and os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            data = data[:len(data) - len(data) % 8]
+            self.keys.update(value for (value,) in struct.iter_unpack("<Q", data))
+
+    @staticmethod
+    def key(url):
+        return int.from_bytes(hashlib.blake2b(normalize_url(url).encode(), digest_size=8).digest(), "big")
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, url):
+        return bool(url) and self.key(url) in self.keys
+
+    def add(self, url):
+        if not url:
+            return
+        key = self.key(url)
+        if key not in self.keys:
+            self.keys.add(key)
+            self.pending.append(key)
+
+    def sync(self, db):
+        # Adds all URLs already stored in MongoDB, used to build the set for an existing database
+        for doc in db["captions"].find({}, {"caption_url": 1, "image_url": 1}):
+            self.add(doc.get("caption_url"))
+            self.add(doc.get("image_url"))
+        for doc in db["images.files"].find({}, {"filename": 1}):
+            self.add(doc.get("filename"))
+
+    def save(self):
+        if not self.path or not self.pending:
+            return
+        with open(self.path, "ab") as f:
+            f.write(b"".join(struct.pack("<Q", key) for key in self.pending))
+        self.pending = []
@@ -1,75 +1,313 @@
 #!/usr/bin/env python3
 
 from pymongo import MongoClient
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import gridfs
+from gridfs.errors import FileExists
 import json
 import base64
 import sys
 import requests
+from caption_index import caption_fingerprint
+from blob_cache import content_digest
+from run_journal import item_key
+from hash_index import chunk_keys
+from image_normalize import normalize_image
+from image_hashing import DECODE_ERRORS
+from record_stream import read_records
+from fetch import Fetcher
+import metrics
 
 class StoreInMongo:
-    def __init__(self, db_name, db_address):
-        # Connect to the local MongoDB server
-        self.client = MongoClient(db_address)
-        self.db = self.client[db_name]
+    def __init__(self, db_name, db_address=None, client=None, blob_cache=None,
+                 batch_size=100, write_concern=None, upload_workers=4, fetcher=None,
+                 normalize=None, image_pool=None):
+        # Connect to the local MongoDB server unless a shared client is handed in
+        self.owns_client = client is None
+        self.client = client if client is not None else MongoClient(db_address)
+        # write_concern is a dict like {"w": 1, "j": False}, the server default is used otherwise
+        if write_concern:
+            self.db = self.client.get_database(db_name, write_concern=WriteConcern(**write_concern))
+        else:
+            self.db = self.client[db_name]
         self.fs = gridfs.GridFS(self.db, collection='images')
+        self.files = self.db['images.files']
+        self.chunks = self.db['images.chunks']
         self.captions_collection = self.db['captions']
+        # Images downloaded during the extraction are read from here instead of downloading them again
+        self.blob_cache = blob_cache
+        self.batch_size = batch_size
+        self.fetcher = fetcher or Fetcher()
+        # GridFS uploads of one batch run in parallel
+        self.upload_pool = ThreadPoolExecutor(max_workers=upload_workers)
+        # Options of normalize_image (format, quality, max_size, ...), images are stored as
+        # served without them. The re-encoding runs in image_pool if one is handed in.
+        self.normalize = normalize
+        self.image_pool = image_pool
+        self.ensure_indexes()
 
-    def insert_data(self, data_list):
+    def ensure_indexes(self):
+        # create_index is a no-op if the index already exists
+        self.captions_collection.create_index('image_hash')
+        # Range queries of the dedup window and the (scrape_time, _id) order of the full sweep
+        self.captions_collection.create_index([('scrape_time', 1), ('_id', 1)])
+        self.captions_collection.create_index('caption_url')
+        # The duplicate check looks up captions by their LSH bands within the dedup window
+        self.captions_collection.create_index([('caption_lsh', 1), ('scrape_time', 1)])
+        # Queue workers look up near duplicate images by their hash chunks
+        self.captions_collection.create_index([('hash_chunks', 1), ('scrape_time', 1)])
+        # Images are stored once per content. Files stored before that have no digest.
+        self.files.create_index('sha256', unique=True, partialFilterExpression={'sha256': {'$exists': True}})
+        self.files.create_index('refcount')
+        self.captions_collection.create_index('image_id')
+        # Items written again after an interrupted run are rejected instead of stored twice
+        self.captions_collection.create_index('item_key', unique=True,
+                                              partialFilterExpression={'item_key': {'$exists': True}})
+
+    def insert_data(self, data_list, on_batch=None):
+        # on_batch is called after every batch with the items that are in the database now
+        batch = []
         for item in data_list:
-            image_url = item.get("full_img_url")
-            caption_url = item.get("caption_url")
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self.insert_batch(batch, on_batch)
+                batch = []
+        if batch:
+            self.insert_batch(batch, on_batch)
+
+    def insert_batch(self, batch, on_batch=None):
+        with metrics.timer("stage_seconds", stage="StoreInMongo"):
+            stored_items = self.write_batch(batch)
+        if on_batch is not None:
+            on_batch(stored_items)
+        return stored_items
+
+    def write_batch(self, batch):
+        # Returns the items that were written or were already stored. Items whose image
+        # could not be fetched are left out. Items with the same image content share one upload
+        groups = {}
+        for item in batch:
+            groups.setdefault(image_key(item), []).append(item)
+        file_ids = dict(zip(groups, self.upload_pool.map(
+            lambda items: self.store_image(items[0], references=len(items)), groups.values())))
+
+        caption_docs = []
+        stored_items = []
+        for item in batch:
+            stored_image = file_ids[image_key(item)]
+            if stored_image is None:
+                continue
+            stored_items.append(item)
+            file_id, thumbnail_id = stored_image
             caption = item.get("caption")
-            scrape_time = item.get("scrape_time")
-            image_hash = item.get("image_hash")
-            
-            # Load image from the image URL
+            # Store caption details in MongoDB
+            caption_docs.append({
+                'caption': caption,
+                'image_id': file_id,
+                'thumbnail_id': thumbnail_id,
+                'created_at': datetime.now(),
+                'caption_url': item.get("caption_url"),
+                'image_url': item.get("full_img_url"),
+                'scrape_time': item.get("scrape_time"),
+                'image_hash': item.get("image_hash"),
+                'caption_lsh': item.get("caption_lsh") or caption_fingerprint(caption),
+                'item_key': item.get("item_key") or item_key(item),
+                'hash_chunks': hash_chunks(item.get("image_hash"))
+            })
+        stored = len(caption_docs)
+        if caption_docs:
             try:
-                response = requests.get(image_url)
+                self.captions_collection.insert_many(caption_docs, ordered=False)
+            except BulkWriteError as e:
+                # The images of the captions that were not written lose their reference again
+                errors = e.details.get('writeErrors', [])
+                for error in errors:
+                    self.release(caption_docs[error['index']]['image_id'])
+                # Already stored items (same item_key) are fine, everything else is an error
+                if any(error.get('code') != 11000 for error in errors) or e.details.get('writeConcernErrors'):
+                    raise
+                stored -= len(errors)
+                metrics.inc("documents_already_stored_total", len(errors))
+        metrics.inc("documents_stored_total", stored)
+        return stored_items
+
+    def store_image(self, item, references=1):
+        # Returns (file_id, thumbnail_id) of the GridFS files with the content of the image.
+        # Existing files are reused and get `references` more references, new images are uploaded.
+        image_url = item.get("full_img_url")
+        image_digest = item.get("image_digest")
+
+        # Known content, nothing to download or upload
+        if image_digest:
+            file_doc = self.add_reference(image_digest, references)
+            if file_doc is not None:
+                metrics.inc("images_deduplicated_total")
+                return file_doc['_id'], file_doc.get('thumbnail_id')
+
+        image_data = None
+        if self.blob_cache is not None and image_digest:
+            image_data = self.blob_cache.get(image_digest)
+
+        # Load image from the image URL if it is not cached
+        if image_data is None:
+            try:
+                response = self.fetcher.get_image(image_url)
+                metrics.inc("image_cache_misses_total")
                 response.raise_for_status()
                 image_data = response.content
             except requests.exceptions.RequestException as e:
                 print(f"Error retrieving image: {e}", file=sys.stderr)
-                continue
+                return None
+            # The image may have changed since it was hashed
+            image_digest = content_digest(image_data)
+            file_doc = self.add_reference(image_digest, references)
+            if file_doc is not None:
+                metrics.inc("images_deduplicated_total")
+                return file_doc['_id'], file_doc.get('thumbnail_id')
 
-            # Store image in GridFS
-            file_id = self.fs.put(image_data, filename=image_url)
+        return self.upload(image_data, image_url, image_digest, references)
 
-            # Store caption details in MongoDB
-            caption_doc = {
-                'caption': caption,
-                'image_id': file_id,
-                'created_at': datetime.now(),
-                'caption_url': caption_url,
-                'scrape_time': scrape_time,
-                'image_hash': image_hash
-            }
-            self.captions_collection.insert_one(caption_doc)
+    def upload(self, image_data, image_url, image_digest, references):
+        # The file keeps the sha256 of the bytes as served, also if it stores a re-encoded
+        # version. That way the same source image is found without re-encoding it.
+        metadata = {}
+        thumbnail = None
+        if self.normalize is not None:
+            try:
+                with metrics.timer("stage_seconds", stage="NormalizeImage"):
+                    image_data, thumbnail, metadata = self.normalize_image(image_data)
+            except DECODE_ERRORS:
+                # Stored as served
+                metrics.inc("image_decode_errors_total")
+                metrics.inc("image_normalize_errors_total")
+        # The thumbnail is stored first, so a file never points to a missing thumbnail
+        thumbnail_id = None
+        if thumbnail is not None:
+            thumbnail_id = self.fs.put(thumbnail, filename=image_url, variant='thumbnail',
+                                       content_type=metadata.get('content_type'))
+
+        # Store image in GridFS. The unique index on sha256 makes a concurrent upload
+        # of the same content fail, the reference is added to that file instead.
+        file_id = ObjectId()
+        try:
+            self.fs.put(image_data, _id=file_id, filename=image_url, sha256=image_digest,
+                        refcount=references, thumbnail_id=thumbnail_id, **metadata)
+        except (FileExists, DuplicateKeyError):
+            self.chunks.delete_many({'files_id': file_id})
+            if thumbnail_id is not None:
+                self.fs.delete(thumbnail_id)
+            file_doc = self.add_reference(image_digest, references)
+            return (file_doc['_id'], file_doc.get('thumbnail_id')) if file_doc is not None else None
+        metrics.observe("stored_image_bytes", len(image_data), metrics.SIZE_BUCKETS)
+        return file_id, thumbnail_id
+
+    def normalize_image(self, image_data):
+        if self.image_pool is not None:
+            return self.image_pool.submit(normalize_image, image_data, **self.normalize).result()
+        return normalize_image(image_data, **self.normalize)
+
+    def add_reference(self, image_digest, references=1):
+        # Returns the file document (_id, thumbnail_id) with this content, or None if there is none
+        return self.files.find_one_and_update({'sha256': image_digest},
+                                              {'$inc': {'refcount': references}},
+                                              projection={'_id': True, 'thumbnail_id': True})
+
+    def release(self, image_id, references=1):
+        # Called when captions that point to the image are deleted
+        self.files.update_one({'_id': image_id}, {'$inc': {'refcount': -references}})
+
+    def remove(self, caption_id):
+        # Deletes a caption document and releases its image
+        doc = self.captions_collection.find_one_and_delete({'_id': caption_id}, projection={'image_id': True})
+        if doc is not None and doc.get('image_id') is not None:
+            self.release(doc['image_id'])
+
+    def collect_garbage(self):
+        # Deletes the files nothing refers to anymore. The refcount condition in the delete
+        # keeps files that got a new reference in the meantime.
+        deleted = 0
+        for file_doc in self.files.find({'refcount': {'$lte': 0}}, {'_id': True, 'thumbnail_id': True}):
+            file_id = file_doc['_id']
+            if self.captions_collection.find_one({'image_id': file_id}, {'_id': True}):
+                continue
+            if self.files.delete_one({'_id': file_id, 'refcount': {'$lte': 0}}).deleted_count:
+                self.chunks.delete_many({'files_id': file_id})
+                if file_doc.get('thumbnail_id') is not None:
+                    self.fs.delete(file_doc['thumbnail_id'])
+                deleted += 1
+        metrics.inc("images_collected_total", deleted)
+        return deleted
+
+    def backfill_digests(self):
+        # Files stored before the content addressing get their digest and reference count.
+        # Byte-identical files are merged, their captions then point to the remaining file.
+        merged = 0
+        # Thumbnails have no digest of their own
+        for file_doc in self.files.find({'sha256': {'$exists': False}, 'variant': {'$exists': False}}, {'_id': True}):
+            file_id = file_doc['_id']
+            image_digest = content_digest(self.fs.get(file_id).read())
+            references = self.captions_collection.count_documents({'image_id': file_id})
+            try:
+                self.files.update_one({'_id': file_id}, {'$set': {'sha256': image_digest, 'refcount': references}})
+            except DuplicateKeyError:
+                existing = self.add_reference(image_digest, references)
+                self.captions_collection.update_many({'image_id': file_id}, {'$set': {
+                    'image_id': existing['_id'], 'thumbnail_id': existing.get('thumbnail_id')}})
+                self.fs.delete(file_id)
+                merged += 1
+        return merged
 
     def close_connection(self):
-        self.client.close()
+        self.upload_pool.shutdown()
+        if self.owns_client:
+            self.client.close()
+
+def hash_chunks(image_hash):
+    try:
+        return chunk_keys(image_hash) if image_hash else []
+    except ValueError:
+        return []
+
+def image_key(item):
+    # Items without a digest are never grouped
+    return item.get("image_digest") or id(item)
+
+def collect(db_name, db_adress):
+    # Maintenance: adds digests to old files, merges their copies and deletes unreferenced files
+    mongo_store = StoreInMongo(db_name, db_adress)
+    try:
+        merged = mongo_store.backfill_digests()
+        deleted = mongo_store.collect_garbage()
+        print(f"Merged {merged} duplicate images, deleted {deleted} unreferenced images.")
+    finally:
+        mongo_store.close_connection()
 
 def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--gc":
+        collect(sys.argv[2], sys.argv[3])
+        return
     if len(sys.argv) != 4:
-        print("Usage: python3 store_in_mongo.py <checked_data.json>", file=sys.stderr)
+        print("Usage: python3 store_in_mongo.py <checked_data.jsonl|-> <db_name> <client_address>", file=sys.stderr)
+        print("       python3 store_in_mongo.py --gc <db_name> <client_address>", file=sys.stderr)
         sys.exit(1)
 
     input_file = sys.argv[1]
     db_name = sys.argv[2]
     db_adress = sys.argv[3]
 
+    # Store in MongoDB, the records are inserted batch by batch while they are read
+    mongo_store = StoreInMongo(db_name,db_adress)
     try:
-        with open(input_file, 'r') as f:
-            data_list = json.load(f)
+        mongo_store.insert_data(read_records(input_file))
     except Exception as e:
         print(f"Error loading data file: {e}", file=sys.stderr)
         sys.exit(1)
-
-    # Store in MongoDB
-    mongo_store = StoreInMongo(db_name,db_adress)
-    mongo_store.insert_data(data_list)
-    mongo_store.close_connection()
+    finally:
+        mongo_store.close_connection()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+import os
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from find_pic_caption import FindPicCaption, to_record
+from pipeline import PipelineError
+from caption_index import caption_fingerprint
+from image_hashing import DECODE_ERRORS
+from run_journal import item_key
+import metrics
+
+# Job queue mode: a coordinator finds the articles of all sites and puts one job per
+# article into the `jobs` collection, any number of workers on any number of machines
+# claim the jobs and download, hash, check and store the articles.
+#
+# A claimed job is leased for lease_seconds. A worker that dies leaves the lease to
+# expire, after which the job is queued again. Failed jobs and expired leases are
+# retried with a growing delay until max_attempts is reached.
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+class WorkQueue:
+    def __init__(self, db, lease_seconds=120, max_attempts=5, retry_seconds=30):
+        self.jobs = db['jobs']
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        # Claimable jobs and expired leases are both found by state and available_at
+        self.jobs.create_index([('state', ASCENDING), ('available_at', ASCENDING)])
+
+    def enqueue(self, site_name, page_url, candidates):
+        # Returns the number of new jobs. The job id is the item key of the article, so an
+        # article found again (by this or another coordinator) is not queued twice.
+        now = utcnow()
+        operations = []
+        for full_img_url, caption_url, caption in candidates:
+            record = {"full_img_url": full_img_url, "caption_url": caption_url, "caption": caption}
+            operations.append(UpdateOne({'_id': item_key(record)}, {'$setOnInsert': {
+                **record,
+                'site': site_name,
+                'page_url': page_url,
+                'state': QUEUED,
+                'attempts': 0,
+                'available_at': now,
+                'created_at': now,
+            }}, upsert=True))
+        if not operations:
+            return 0
+        added = self.jobs.bulk_write(operations, ordered=False).upserted_count
+        metrics.inc("jobs_enqueued_total", added)
+        return added
+
+    def retry_delay(self, attempts):
+        return timedelta(seconds=self.retry_seconds * 2 ** (attempts - 1))
+
+    def requeue_expired(self):
+        # Jobs whose worker died or ran longer than lease_seconds count as a failed attempt:
+        # they are queued again with the retry delay, or fail once max_attempts is reached
+        now = utcnow()
+        for job in self.jobs.find({'state': LEASED, 'available_at': {'$lte': now}},
+                                  {'attempts': 1, 'worker': 1, 'available_at': 1}):
+            if job['attempts'] >= self.max_attempts:
+                update = {'state': FAILED, 'finished_at': now, 'error': "lease expired"}
+            else:
+                update = {'state': QUEUED, 'available_at': now + self.retry_delay(job['attempts']),
+                          'error': "lease expired"}
+            # Only if no other process handled the job in the meantime
+            result = self.jobs.update_one({'_id': job['_id'], 'state': LEASED, 'worker': job.get('worker'),
+                                           'available_at': job['available_at']}, {'$set': update})
+            if result.modified_count:
+                metrics.inc("jobs_lease_expired_total", final=str(update['state'] == FAILED).lower())
+
+    def claim(self, worker_id):
+        self.requeue_expired()
+        now = utcnow()
+        return self.jobs.find_one_and_update(
+            {'state': QUEUED, 'available_at': {'$lte': now}, 'attempts': {'$lt': self.max_attempts}},
+            {'$set': {'state': LEASED, 'worker': worker_id,
+                      'available_at': now + timedelta(seconds=self.lease_seconds)},
+             '$inc': {'attempts': 1}},
+            sort=[('available_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def complete(self, job, state=DONE, error=None):
+        # Only the worker holding the lease may finish the job
+        update = {'state': state, 'finished_at': utcnow()}
+        if error is not None:
+            update['error'] = error
+        self.jobs.update_one({'_id': job['_id'], 'worker': job['worker'], 'state': LEASED}, {'$set': update})
+        metrics.inc("jobs_finished_total", state=state)
+
+    def fail(self, job, error):
+        if job['attempts'] >= self.max_attempts:
+            update = {'state': FAILED, 'finished_at': utcnow(), 'error': error}
+        else:
+            update = {'state': QUEUED, 'available_at': utcnow() + self.retry_delay(job['attempts']), 'error': error}
+        self.jobs.update_one({'_id': job['_id'], 'worker': job['worker'], 'state': LEASED}, {'$set': update})
+        metrics.inc("jobs_failed_total", final=str(update['state'] == FAILED).lower())
+
+    def counts(self):
+        return {doc['_id']: doc['count'] for doc in self.jobs.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}])}
+
+
+class Coordinator:
+    # Finds the articles of all sites and queues them, nothing is downloaded but the pages
+    def __init__(self, pipeline, work_queue):
+        self.pipeline = pipeline
+        self.work_queue = work_queue
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.pipeline.site_workers) as pool:
+            results = list(pool.map(self.enqueue_site, self.pipeline.sites))
+        # The queued articles are the responsibility of the workers now
+        self.pipeline.seen_set.save()
+        errors = [error for _, error in results if error is not None]
+        if errors and len(errors) == len(results):
+            raise PipelineError(str(errors[0]))
+        added = sum(site_added for site_added, _ in results)
+        logging.info(f"Queued {added} new articles. Jobs: {self.work_queue.counts()}")
+        return added
+
+    def enqueue_site(self, site):
+        # Returns the number of queued articles and the error if the site failed
+        subpage_url = None
+        try:
+            subpage_url = self.pipeline.find_subpage_url(site)
+            pic_caption = FindPicCaption(subpage_url, site.top_tag_name, site.img_tag_1, site.cap_tag,
+                                         site.img_tag_2, site.img_tag_3,
+                                         http_cache=self.pipeline.http_cache,
+                                         seen_set=self.pipeline.seen_set,
+                                         fetcher=self.pipeline.fetcher)
+            candidates = pic_caption.get_candidates()
+            added = self.work_queue.enqueue(site.name, subpage_url, candidates)
+            for full_img_url, caption_url, _ in candidates:
+                self.pipeline.seen_set.add(full_img_url)
+                self.pipeline.seen_set.add(caption_url)
+            return added, None
+        except Exception as e:
+            logging.exception(f"{site.name}: Error queueing site")
+            metrics.inc("site_errors_total", site=site.name)
+            if subpage_url:
+                self.pipeline.http_cache.forget(subpage_url)
+            return 0, e
+
+
+class Worker:
+    # Claims jobs and runs download, hash, duplicate check and storage for each of them.
+    # The duplicate check is done twice: before the insert against the local hash index
+    # (cheap, catches almost everything) and after the insert against the database, which
+    # also sees the articles stored at the same time by other workers.
+    def __init__(self, pipeline, work_queue, threads=4, poll_seconds=2.0, window_seconds=60):
+        self.pipeline = pipeline
+        self.work_queue = work_queue
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # The local duplicate indexes are shared by the threads
+        self.check_lock = threading.Lock()
+        self.window_seconds = window_seconds
+        self.window_updated = None
+        # One instance for all threads, so max_per_host holds for the whole worker
+        self.pic_caption = FindPicCaption(None, None, None, None,
+                                          max_per_host=pipeline.image_workers_per_host,
+                                          blob_cache=pipeline.blob_cache,
+                                          hash_pool=pipeline.hash_pool,
+                                          fetcher=pipeline.fetcher)
+
+    def run(self, stop):
+        logging.info(f"Worker {self.worker_id} started with {self.threads} threads.")
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            for thread in range(self.threads):
+                pool.submit(self.work, f"{self.worker_id}:{thread}", stop)
+        logging.info(f"Worker {self.worker_id} stopped.")
+
+    def work(self, worker_id, stop):
+        # Errors never end the loop, nobody reads the result of this thread. A job whose
+        # state could not be written is claimed again once its lease expires.
+        while not stop.is_set():
+            try:
+                job = self.work_queue.claim(worker_id)
+            except Exception:
+                logging.exception("Error claiming a job")
+                stop.wait(self.poll_seconds)
+                continue
+            if job is None:
+                stop.wait(self.poll_seconds)
+                continue
+            try:
+                self.run_job(job)
+            except Exception:
+                logging.exception(f"Error finishing job {job['_id']}")
+                metrics.inc("worker_errors_total")
+                stop.wait(self.poll_seconds)
+
+    def run_job(self, job):
+        # Download errors are retried, an image that cannot be decoded will not get better
+        try:
+            state = self.process(job)
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Job {job['_id']}: image download failed: {e}")
+            self.work_queue.fail(job, f"image download failed: {e}")
+            return
+        except DECODE_ERRORS as e:
+            logging.warning(f"Job {job['_id']}: image could not be decoded: {e}")
+            self.work_queue.complete(job, FAILED, error=f"image could not be decoded: {e}")
+            return
+        except Exception as e:
+            logging.exception(f"Job {job['_id']} failed")
+            self.work_queue.fail(job, str(e))
+            return
+        if state is None:
+            self.work_queue.fail(job, "image could not be stored")
+        else:
+            self.work_queue.complete(job, state)
+
+    def process(self, job):
+        # Returns the final job state, or None if the image could not be stored. Download
+        # and decode errors are raised.
+        pipeline = self.pipeline
+        with metrics.timer("stage_seconds", stage="FindPicCaption"):
+            article = self.pic_caption.download_image((job['full_img_url'], job['caption_url'], job['caption']))
+        record = to_record(article)
+        record["item_key"] = job['_id']
+        record["caption_lsh"] = caption_fingerprint(record["caption"].lower())
+        checker = pipeline.duplicate_checker
+        try:
+            with self.check_lock:
+                self.update_window()
+                with metrics.timer("stage_seconds", stage="CheckDuplicate"):
+                    duplicate = checker.is_duplicate(record["image_hash"], record["caption"],
+                                                     caption_keys=record["caption_lsh"])
+            if duplicate:
+                return DUPLICATE
+
+            pipeline.mongo_store.insert_batch([record])
+            # The item key is unique, a job retried after a crash finds its earlier insert
+            stored = pipeline.mongo_store.captions_collection.find_one({'item_key': job['_id']}, {'_id': 1})
+            if stored is None:
+                return None
+            with metrics.timer("stage_seconds", stage="CheckConcurrentDuplicate"):
+                duplicates = checker.find_concurrent_duplicates(stored['_id'], record["image_hash"],
+                                                                record["caption"], record["caption_lsh"])
+            # The smaller _id of every pair survives, also when the other document belongs to
+            # another worker. remove() is idempotent, so both workers may remove the same one.
+            state = DONE
+            for duplicate_id in duplicates:
+                if duplicate_id < stored['_id']:
+                    state = DUPLICATE
+                else:
+                    pipeline.mongo_store.remove(duplicate_id)
+            if state == DUPLICATE:
+                pipeline.mongo_store.remove(stored['_id'])
+            return state
+        finally:
+            pipeline.blob_cache.discard(record["image_digest"])
+
+    def update_window(self):
+        # The dedup window moves with the time, it is recomputed once a minute
+        now = utcnow()
+        if self.window_updated is None or (now - self.window_updated).total_seconds() >= self.window_seconds:
+            self.pipeline.duplicate_checker.update_window()
+            self.window_updated = now